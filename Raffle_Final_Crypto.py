@@ -1,164 +1,128 @@
+# First, so the startup clock covers the imports below
+import startup
 import os
-import requests
-import random
 import asyncio
 import re
 import logging
-import time
-import psycopg2
+# The payment and database modules are imported eagerly: post_init needs them before the first
+# update is served, and most of their import time is httpx and telegram, which the bot loads anyway.
+# Only the scheduler's SQLAlchemy job store is imported lazily (see create_scheduler).
+import db
+import cryptobot
+import payments
+import webhook
+import broadcast
+import pool_cache
+import migrations
+import rounds
+import archive
+import updates
+import outbox
+import user_cache
+import payouts
+import metrics
+import leader
+import pool_registry
+import render
+import throttle
+import registration
 from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-from telegram import ReplyKeyboardMarkup
-from datetime import datetime, timezone, timedelta
+from telegram.ext import Application, CommandHandler, ContextTypes, TypeHandler
+from apscheduler.triggers.date import DateTrigger
+from datetime import datetime, timezone
 
 # Set up API tokens
-CRYPTBOT_API_TOKEN = os.getenv('CRYPTBOT_API_TOKEN')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
-# Set up the database connection
-DATABASE_URL = os.getenv('DATABASE_URL')
+# Telegram webhook mode (required to run several replicas behind a load balancer;
+# long polling only allows one consumer per bot token)
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_LISTEN = os.getenv('TELEGRAM_WEBHOOK_LISTEN', '0.0.0.0')
+TELEGRAM_WEBHOOK_PORT = int(os.getenv('PORT', os.getenv('TELEGRAM_WEBHOOK_PORT', '8443')))
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', 'telegram/webhook')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
 
-def get_db_connection():
-    try:
-        logging.info("Attempting to connect to the database...")
-        connection = psycopg2.connect(DATABASE_URL, sslmode='require')
-        logging.info("Database connection established successfully.")
-        return connection
-    except Exception as e:
-        logging.error(f"Failed to connect to the database: {e}")
-        raise e  # Reraise the exception to let the calling function handle it
+# Use uvloop for the event loop when it is installed (set USE_UVLOOP=0 to opt out)
+USE_UVLOOP = os.getenv('USE_UVLOOP', '1') == '1'
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
-# CryptoBot API endpoint
-CRYPTBOT_API_URL = 'https://pay.crypt.bot/api/'
-
-# Pool entry fees
-bronze_entry_fee = 10.0
-silver_entry_fee = 25.0
-gold_entry_fee = 50.0
-
-# Pool status variables
-next_bronze_start_time = None
-next_bronze_end_time = None
-
-next_silver_start_time = None
-next_silver_end_time = None
-
-next_gold_start_time = None
-next_gold_end_time = None
-
-# Bot's cut percentage
-bot_cut_percentage = 10
+# Best effort: an invoice that is left behind expires on CryptoBot after INVOICE_TIMEOUT anyway
+async def delete_invoice(invoice_id):
+    try:
+        await cryptobot.call('deleteInvoice', {'invoice_id': invoice_id}, max_retries=1)
+    except cryptobot.CryptoBotError as e:
+        logging.warning(f"Could not delete invoice {invoice_id}: {e}")
 
 # Function to create an invoice for payment (only accepts USDT)
-def create_invoice(amount, description, chat_id, pool_name, max_retries=3):
-    url = CRYPTBOT_API_URL + 'createInvoice'
-    headers = {'Content-Type': 'application/json', 'Crypto-Pay-API-Token': CRYPTBOT_API_TOKEN}
+async def create_invoice(amount, description, chat_id, pool_name, max_retries=3):
     payload = {
         'amount': str(amount),
         'currency_type': 'fiat',
         'fiat': 'USD',
         'accepted_assets': 'USDT',
         'description': description,
+        # CryptoBot stops accepting payment when the reconciliation worker gives up on the invoice
+        'expires_in': payments.INVOICE_TIMEOUT,
     }
 
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-
-            if response.status_code == 200 and response.json().get('ok'):
-                invoice_url = response.json()['result']['bot_invoice_url']
-                invoice_id = response.json()['result']['invoice_id']
-
-                # Store the invoice in the database
-                try:
-                    conn = get_db_connection()
-                    cur = conn.cursor()
-                    cur.execute("""
-                        INSERT INTO invoices (invoice_id, chat_id, amount, status, pool_name, creation_time)
-                        VALUES (%s, %s, %s, %s, %s, %s);
-                    """, (invoice_id, chat_id, amount, 'pending', pool_name, datetime.now(timezone.utc)))
-                    
-                    conn.commit()
-                    cur.close()
-                    conn.close()
-                except Exception as e:
-                    logging.error(f"Database error: {e}")
-
-                return invoice_url, invoice_id
-            else:
-                logging.error(f"Error in invoice creation: {response.json()}")
-                return None, None
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"HTTP request failed: {e}. Attempt {attempt + 1} of {max_retries}")
-            time.sleep(2 ** attempt)
-
-    logging.error("Failed to create invoice after multiple attempts.")
-    return None, None
-
-# Function to check payment status
-def check_payment(invoice_id):
-    url = CRYPTBOT_API_URL + 'getInvoice'
-    headers = {'Content-Type': 'application/json', 'Crypto-Pay-API-Token': CRYPTBOT_API_TOKEN}
-    payload = {'invoice_id': invoice_id}
-    response = requests.post(url, json=payload, headers=headers)
-
-    if response.status_code == 200 and response.json().get('ok'):
-        status = response.json()['result']['status']
-        return status == 'paid'
-    return False
-
-# Updated check_payment_status without invoice_tracker usage
-async def check_payment_status(context: ContextTypes.DEFAULT_TYPE):
-    job_data = context.job.data
-    chat_id = job_data['chat_id']
-    invoice_id = job_data['invoice_id']
-    pool_name = job_data['pool_name']
+    try:
+        response = await cryptobot.call('createInvoice', payload, max_retries=max_retries)
+    except cryptobot.CryptoBotError as e:
+        logging.error(f"Failed to create invoice: {e}")
+        return None, None
 
-    if check_payment(invoice_id):
-        # Payment is successful, mark invoice as 'paid'
-        try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            
-            # Update the invoice status to 'paid'
-            cur.execute("UPDATE invoices SET status = 'paid' WHERE invoice_id = %s;", (invoice_id,))
-            
-            # Insert into pool_participants
-            cur.execute("INSERT INTO pool_participants (chat_id, pool_name, invoice_id) VALUES (%s, %s, %s);", (chat_id, pool_name, invoice_id))
-            
-            conn.commit()
-            cur.close()
-            conn.close()
-        except Exception as e:
-            logging.error(f"Database error: {e}")
+    if not response.get('ok'):
+        logging.error(f"Error in invoice creation: {response}")
+        return None, None
+
+    invoice_url = response['result']['bot_invoice_url']
+    invoice_id = response['result']['invoice_id']
+
+    # Store the invoice in the database, unless a concurrent join of this user already stored one
+    try:
+        existing = await db.run_transaction(payments.store_invoice, invoice_id, chat_id, amount, pool_name, invoice_url)
+    except Exception as e:
+        logging.error(f"Database error: {e}")
+        # A payment of an invoice that is not stored could never be credited, so it is not handed out
+        await delete_invoice(invoice_id)
+        return None, None
+    if existing is not None:
+        # Hand out the existing link; the new invoice is never shown, so delete it
+        logging.debug(f"User {chat_id} already got a pending invoice for the {pool_name}, deleting invoice {invoice_id}")
+        await delete_invoice(invoice_id)
+        return existing
+
+    return invoice_url, invoice_id
+
+# Pay out queued prizes (safe to run on several replicas at once)
+async def process_payouts(context: ContextTypes.DEFAULT_TYPE):
+    await payouts.drain(context.bot)
+
+# Single reconciliation worker: polls every pending invoice in batches with getInvoices.
+# Only the leader runs it so replicas do not poll the same invoices.
+@leader.leader_only
+async def check_payment_status(context: ContextTypes.DEFAULT_TYPE):
+    await payments.reconcile_pending_invoices(context.bot)
+
+# Move closed rounds and settled invoices and transfers out of the active partitions
+@leader.leader_only
+async def archive_history(context: ContextTypes.DEFAULT_TYPE):
+    await archive.archive_finished_rows()
+
+# Store a wallet address and let every process drop its cached copy of the user once this commits.
+# The user's unpaid prizes are retried with the new wallet; returns how many there are.
+def _save_wallet(cur, chat_id, wallet_address):
+    cur.execute("""
+        INSERT INTO users (chat_id, wallet_address) 
+        VALUES (%s, %s)
+        ON CONFLICT (chat_id) 
+        DO UPDATE SET wallet_address = EXCLUDED.wallet_address;
+    """, (chat_id, wallet_address))
+    user_cache.notify_users(cur, [chat_id])
+    return payouts.requeue_user(cur, chat_id)
 
-        # Send confirmation message
-        await context.bot.send_message(chat_id=chat_id, text=f"You have successfully joined the {pool_name}!")
-    else:
-        # Timeout after 15 minutes (900 seconds)
-        if (datetime.now(timezone.utc) - job_data['creation_time']).total_seconds() > 900:
-            try:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                # Update the invoice status to 'expired'
-                cur.execute("UPDATE invoices SET status = 'expired' WHERE invoice_id = %s;", (invoice_id,))
-                conn.commit()
-                cur.close()
-                conn.close()
-            except Exception as e:
-                logging.error(f"Database error while updating invoice status: {e}")
-
-            await context.bot.send_message(chat_id=chat_id, text="Your payment verification has timed out. Please try again.")
-        else:
-            # Reschedule the payment check if not yet completed
-            context.job_queue.run_once(check_payment_status, 60, data=job_data)       
 # Function to set the user's wallet address
 async def set_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -171,234 +135,90 @@ async def set_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-
             # Insert or update the user's wallet address in the database
-            cur.execute("""
-                INSERT INTO users (chat_id, wallet_address) 
-                VALUES (%s, %s)
-                ON CONFLICT (chat_id) 
-                DO UPDATE SET wallet_address = EXCLUDED.wallet_address;
-            """, (chat_id, wallet_address))
-            
-            conn.commit()
-            cur.close()
-            conn.close()
-
-            await context.bot.send_message(chat_id=chat_id, text=f"Your wallet address has been set to: {wallet_address}")
+            requeued = await db.run_transaction(_save_wallet, chat_id, wallet_address)
+            user_cache.invalidate_users([chat_id])
+
+            text = f"Your wallet address has been set to: {wallet_address}"
+            if requeued:
+                text += "\nYour unpaid prizes will be sent to this wallet shortly."
+            await context.bot.send_message(chat_id=chat_id, text=text)
         except Exception as e:
             logging.error(f"Database error: {e}")
             await context.bot.send_message(chat_id=chat_id, text="An error occurred while setting your wallet. Please try again.")
     else:
         await context.bot.send_message(chat_id=chat_id, text="Please provide a wallet address. Usage: /set_wallet <WALLET_ADDRESS>")
 
-def transfer_to_winner(user_id, amount, asset='USDT', max_retries=3):
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Fetch the wallet address from the database
-        cur.execute("""
-            SELECT wallet_address FROM users WHERE chat_id = %s;
-        """, (user_id,))
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
-
-        if result is None:
-            logging.error(f"User ID {user_id} has not set a wallet address.")
-            return False, "No wallet address found. Please set your wallet address using /set_wallet."
-
-        wallet_address = result[0]
-        prize_amount = amount * (1 - bot_cut_percentage / 100)
-
-        url = CRYPTBOT_API_URL + 'transfer'
-        headers = {
-            'Content-Type': 'application/json',
-            'Crypto-Pay-API-Token': CRYPTBOT_API_TOKEN
-        }
-        payload = {
-            'user_id': wallet_address,
-            'asset': asset,
-            'amount': str(prize_amount),
-            'spend_id': str(random.randint(1, 1000000)),
-            'comment': 'Congratulations! You have won the lucky draw!'
-        }
-
-        for attempt in range(max_retries):
-            try:
-                response = requests.post(url, json=payload, headers=headers)
-                response.raise_for_status()
-
-                if response.status_code == 200 and response.json().get('ok'):
-                    logging.info(f"Successfully transferred {prize_amount} {asset} to wallet address {wallet_address}.")
-                    
-                    # Log the successful transfer to the database
-                    conn = get_db_connection()
-                    cur = conn.cursor()
-                    cur.execute("""
-                        INSERT INTO transfers (chat_id, amount, asset, status, timestamp)
-                        VALUES (%s, %s, %s, %s, %s);
-                    """, (user_id, prize_amount, asset, 'successful', datetime.now(timezone.utc)))
-                    conn.commit()
-                    cur.close()
-                    conn.close()
-
-                    return True, None
-                else:
-                    error_message = response.json().get('error', {}).get('message', 'Unknown error')
-                    logging.error(f"Error during transfer: {error_message}")
-                    return False, error_message
-
-            except requests.exceptions.RequestException as e:
-                logging.error(f"HTTP request failed during transfer: {e}. Attempt {attempt + 1} of {max_retries}")
-                time.sleep(2 ** attempt)  # Implement exponential backoff
-
-        logging.error("Failed to transfer to winner after multiple attempts.")
-        return False, "Transfer failed. Please try again later."
-    
-    except Exception as e:
-        logging.error(f"Database error: {e}")
-        return False, "Database error while fetching wallet address."
-
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    logging.info(f"Received /start command from chat_id: {chat_id}")
-    
-    try:
-        # Insert the user into the database if they don't already exist
-        logging.info(f"Attempting to insert user {chat_id} into the database.")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO users (chat_id) 
-            VALUES (%s)
-            ON CONFLICT (chat_id) DO NOTHING;
-        """, (chat_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
-        logging.info(f"User {chat_id} inserted successfully.")
-    
-    except Exception as e:
-        logging.error(f"Database error in start_command: {e}")
-        await context.bot.send_message(chat_id=chat_id, text="An error occurred while registering you. Please try again.")
-        return
+    logging.debug(f"Received /start command from chat_id: {chat_id}")
 
-    # Define the custom keyboard layout using emojis
-    keyboard = [
-        ["📜 Rules", "📊 Status"],
-        ["🥉 Join Bronze", "🥈 Join Silver", "🥇 Join Gold"],
-        ["👥 Players", "ℹ️ My Info"],
-        ["💰 Pool Size", "🆘 Help"],
-        ["👛 Set Wallet"]
-    ]
-
-    # Create a ReplyKeyboardMarkup object
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
-    
-    # Send a message with the custom keyboard
-    welcome_message = (
-        "🎉 Welcome to the Lucky Draw Pool Bot! 🎉\n\n"
-        "Use the buttons below to navigate through the commands.\n"
-        "You can join pools, check pool status, view rules, and more!"
-    )
-    await context.bot.send_message(chat_id=chat_id, text=welcome_message, reply_markup=reply_markup)
+    # Queue the user for the next batched insert (returning users are skipped in memory);
+    # the welcome message does not wait for the database
+    registration.register(chat_id)
+
+    # Send a message with the custom keyboard (both built once at startup)
+    await context.bot.send_message(chat_id=chat_id, text=render.WELCOME_MESSAGE, reply_markup=render.KEYBOARD)
 # Function to broadcast a message to all users
 async def broadcast_message(application, message):
+    # Pool announcements are sent once, by the leader
+    if not leader.is_leader():
+        return
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Fetch all chat_ids from the users table
-        cur.execute("SELECT chat_id FROM users;")
-        chat_ids = cur.fetchall()
-
-        cur.close()
-        conn.close()
-
-        # Use async gather to handle multiple send_message calls concurrently
-        await asyncio.gather(*[
-            application.bot.send_message(chat_id=chat_id[0], text=message) for chat_id in chat_ids
-        ])
+        # Stream chat_ids in chunks and send them through the outbound scheduler
+        return await broadcast.broadcast(application.bot, message)
 
     except Exception as e:
         logging.error(f"Database error in broadcast_message: {e}")
 
+# Button presses are throttled per chat. A chat's updates are handled one at a time (see updates.py),
+# so a repeated press runs after the first one and finds its pending invoice.
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     text = update.message.text  # Get the text from the pressed button
-    logging.info(f"Button pressed: {text} by chat_id: {chat_id}")
-    
-    # Map button texts to their respective commands
-    if text == "📜 Rules":
-        await rules(update, context)
-    elif text == "📊 Status":
-        await status(update, context)
-    elif text == "🥉 Join Bronze":
-        await handle_join(update, context, bronze_entry_fee, "Bronze Pool")
-    elif text == "🥈 Join Silver":
-        await handle_join(update, context, silver_entry_fee, "Silver Pool")
-    elif text == "🥇 Join Gold":
-        await handle_join(update, context, gold_entry_fee, "Gold Pool")
-    elif text == "👥 Players":
-        await players(update, context)
-    elif text == "ℹ️ My Info":
-        await my_info(update, context)
-    elif text == "💰 Pool Size":
-        await pool_size(update, context)
-    elif text == "🆘 Help":
-        await help_command(update, context)
-    elif text == "👛 Set Wallet":
-        await context.bot.send_message(chat_id=chat_id, text="Please use the /set_wallet command to set your wallet address.")
-    else:
+    logging.debug(f"Button pressed: {text} by chat_id: {chat_id}")
+
+    if not throttle.allow(chat_id):
+        return
+    await handle_button(update, context, text)
+
+# /join_<pool> commands go through the same throttle as the buttons
+def throttled_command(callback):
+    async def command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = update.effective_chat.id
+        if not throttle.allow(chat_id):
+            return
+        await callback(update, context)
+    return command
+
+def join_callback(pool):
+    async def join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_join(update, context, pool.entry_fee, pool.name)
+    return join
+
+# Button texts are looked up in BUTTONS, built from the command registry at the bottom of this file
+async def handle_button(update, context, text):
+    callback = BUTTONS.get(text)
+    if callback is None:
+        chat_id = update.effective_chat.id
         logging.warning(f"Unknown command received: {text}")
         await context.bot.send_message(chat_id=chat_id, text="Unknown command. Please use the available buttons.")
-
+        return
+    await callback(update, context)
 
 
 # Command to display the rules
 async def rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    await context.bot.send_message(chat_id=chat_id, text=(
-        "Welcome to the Lucky Draw Pool!\n"
-        "1. The Bronze Pool opens every 24 hours and runs for a full day. Entry fee: $10. Use /join_bronze to participate.\n"
-        "2. The Silver Pool opens every 3 days and runs for 24 hours. Entry fee: $25. Use /join_silver to participate.\n"
-        "3. The Gold Pool opens every Sunday and runs for 24 hours. Entry fee: $50. Use /join_gold to participate.\n"
-        "4. At the end of each pool's duration, a winner will be randomly selected.\n"
-        "5. The prize is transferred to the winner after a 10% bot cut.\n"
-        "6. Payments are handled via CryptoBot, and only USDT is accepted for all transactions.\n"
-        "7. Make sure to join only one pool per cycle. Once you join, you cannot join the same pool until it resets."
-    ))
+    await context.bot.send_message(chat_id=chat_id, text=render.RULES_TEXT)
 
 # Command to show the number of players in each pool
 async def players(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Get counts for each pool
-        cur.execute("SELECT COUNT(*) FROM pool_participants WHERE pool_name = %s;", ('Bronze Pool',))
-        bronze_count = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM pool_participants WHERE pool_name = %s;", ('Silver Pool',))
-        silver_count = cur.fetchone()[0]
-
-        cur.execute("SELECT COUNT(*) FROM pool_participants WHERE pool_name = %s;", ('Gold Pool',))
-        gold_count = cur.fetchone()[0]
-
-        cur.close()
-        conn.close()
-
-        await context.bot.send_message(chat_id=chat_id, text=(
-            f"Current Players:\n"
-            f"Bronze Pool: {bronze_count} players\n"
-            f"Silver Pool: {silver_count} players\n"
-            f"Gold Pool: {gold_count} players"
-        ))
+        # Rendered from the cached snapshot, rebuilt only when a count changes
+        await context.bot.send_message(chat_id=chat_id, text=await render.players_text())
     
     except Exception as e:
         logging.error(f"Database error: {e}")
@@ -409,24 +229,12 @@ async def my_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logging.error(f"Database connection failed for chat_id: {chat_id}")
-            await context.bot.send_message(chat_id=chat_id, text="Database connection failed. Please try again later.")
-            return
-
-        cur = conn.cursor()
-        logging.info(f"Executing query to fetch pool participation for chat_id: {chat_id}")
+        logging.debug(f"Executing query to fetch pool participation for chat_id: {chat_id}")
         
-        # Execute the query
-        cur.execute("SELECT pool_name, invoice_id FROM pool_participants WHERE chat_id = %s;", (chat_id,))
-        
-        # Fetch results
-        user_pools = cur.fetchall()
-        logging.info(f"Query result for chat_id {chat_id}: {user_pools}")
-
-        cur.close()
-        conn.close()
+        # Entries in the current rounds only, from this process's user cache (loaded on a miss and
+        # dropped whenever a payment or a round reset changes them)
+        user_pools = list((await user_cache.get_user(chat_id))['memberships'].items())
+        logging.debug(f"Found {len(user_pools)} pool entries for chat_id {chat_id}")
 
         if user_pools:
             pool_info = "\n".join([f"{pool_name} (Invoice ID: {invoice_id})" for pool_name, invoice_id in user_pools])
@@ -441,28 +249,8 @@ async def my_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def pool_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Fetch pool sizes from the database
-        cur.execute("SELECT pool_name, pool_amount FROM pools WHERE pool_name IN ('Bronze Pool', 'Silver Pool', 'Gold Pool');")
-        pools = cur.fetchall()
-
-        pool_sizes = {name: amount for name, amount in pools}
-        bronze_amount = pool_sizes.get('Bronze Pool', 0)
-        silver_amount = pool_sizes.get('Silver Pool', 0)
-        gold_amount = pool_sizes.get('Gold Pool', 0)
-
-        cur.close()
-        conn.close()
-
-        # Send pool sizes to the user
-        await context.bot.send_message(chat_id=chat_id, text=(
-            f"Current Pool Sizes:\n"
-            f"Bronze Pool: ${bronze_amount:.2f}\n"
-            f"Silver Pool: ${silver_amount:.2f}\n"
-            f"Gold Pool: ${gold_amount:.2f}"
-        ))
+        # Send pool sizes to the user, rendered from the cached snapshot
+        await context.bot.send_message(chat_id=chat_id, text=await render.pool_size_text())
     except Exception as e:
         logging.error(f"Database error: {e}")
         await context.bot.send_message(chat_id=chat_id, text="An error occurred while fetching pool sizes. Please try again.")
@@ -470,25 +258,25 @@ async def pool_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Handle joining the pool
 async def handle_join(update, context, entry_fee, pool_name):
     chat_id = update.effective_chat.id
-    logging.info(f"Handling join request for {pool_name} by chat_id: {chat_id}")
+    logging.debug(f"Handling join request for {pool_name} by chat_id: {chat_id}")
     
     try:
         # Connect to the database
-        logging.info(f"Checking if user {chat_id} is already in the {pool_name}")
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Check if user is already in the pool
-        cur.execute("SELECT COUNT(*) FROM pool_participants WHERE chat_id = %s AND pool_name = %s;", (chat_id, pool_name))
-        already_in_pool = cur.fetchone()[0] > 0
+        logging.debug(f"Checking if user {chat_id} is already in the {pool_name}")
+        # Check if user is already in the current round of the pool (from this process's user cache)
+        if pool_name in (await user_cache.get_user(chat_id))['memberships']:
+            logging.debug(f"User {chat_id} is already in the {pool_name}")
+            await context.bot.send_message(chat_id=chat_id, text=f"You are already in the {pool_name}.")
+            return
 
-        cur.close()
-        conn.close()
+        # Look for an unexpired pending invoice for this pool
+        row = await db.run_transaction(payments.find_pending_invoice, chat_id, pool_name)
+        pending_url = row[0] if row else None
 
-        # If the user is already in the pool, send a message and return
-        if already_in_pool:
-            logging.info(f"User {chat_id} is already in the {pool_name}")
-            await context.bot.send_message(chat_id=chat_id, text=f"You are already in the {pool_name}.")
+        # Hand out the existing payment link instead of creating another invoice
+        if pending_url:
+            logging.debug(f"User {chat_id} already has a pending invoice for the {pool_name}")
+            await context.bot.send_message(chat_id=chat_id, text=f"You already have a pending payment for the {pool_name}. Please pay ${entry_fee} using this link: {pending_url}")
             return
 
     except Exception as e:
@@ -497,90 +285,131 @@ async def handle_join(update, context, entry_fee, pool_name):
         return
 
     # Continue with invoice creation
-    logging.info(f"Creating invoice for user {chat_id} to join the {pool_name}")
-    payment_url, invoice_id = create_invoice(entry_fee, f"{pool_name} Entry", chat_id, pool_name)
+    logging.debug(f"Creating invoice for user {chat_id} to join the {pool_name}")
+    payment_url, invoice_id = await create_invoice(entry_fee, f"{pool_name} Entry", chat_id, pool_name)
 
     # If invoice creation was successful, proceed
     if payment_url:
         try:
-            logging.info(f"Invoice created successfully for user {chat_id}. Payment URL: {payment_url}")
+            logging.debug(f"Invoice created successfully for user {chat_id}. Payment URL: {payment_url}")
             # Notify the user to make the payment
+            # The pending invoice is picked up by the check_payment_status worker
             await context.bot.send_message(chat_id=chat_id,
                                            text=f"To join the {pool_name}, please pay ${entry_fee} using this link: {payment_url}\n\n⏳ You have 15 minutes to complete the payment. If you fail to pay in time, you'll need to try again.")
-            
-            # Schedule the payment check
-            context.job_queue.run_once(check_payment_status, 60, data={
-                'chat_id': chat_id,
-                'invoice_id': invoice_id,
-                'pool_name': pool_name,
-                'creation_time': datetime.now(timezone.utc)
-            })
         
         except Exception as e:
-            logging.error(f"Error while scheduling payment check: {e}")
-            await context.bot.send_message(chat_id=chat_id, text="An error occurred while scheduling payment verification. Please try again.")
+            logging.error(f"Error while sending payment link: {e}")
     else:
         # If invoice creation failed, notify the user
         logging.error(f"Failed to create an invoice for user {chat_id}")
         await context.bot.send_message(chat_id=chat_id, text="Error creating payment. Please try again later.")
 
-# Modify start functions to set next opening and closing times
-async def start_bronze_pool(context):
-    global next_bronze_end_time  # Removed bronze_pool_open as it is unused
-    next_bronze_end_time = datetime.now(timezone.utc) + timedelta(hours=24)  # Pool runs for 24 hours
-
-    # Notify all users
-    message = "🥉 The Bronze Pool is now open and will close in 24 hours! Use /join_bronze to participate."
-    await broadcast_message(context.application, message)
-
-    await context.bot.send_message(chat_id=context.job.context, text="The Bronze Pool is now open! Use /join_bronze to participate.")
-
-async def end_bronze_pool(context):
-    global next_bronze_start_time  # Removed bronze_pool_open as it is unused
-    next_bronze_start_time = datetime.now(timezone.utc) + timedelta(days=1)  # Opens next day at 0:00
-    await end_specific_pool(context, bronze_pool_participants, bronze_pool_amount, "Bronze Pool")
-
-async def start_silver_pool(context):
-    global next_silver_end_time  # Removed silver_pool_open as it is unused
-    next_silver_end_time = datetime.now(timezone.utc) + timedelta(hours=24)  # Pool runs for 24 hours
+# Open a new round: record it in the database, update this replica's cache, schedule the
+# one-off end job and announce it
+async def start_pool(application, pool):
+    closes_at = datetime.now(timezone.utc) + pool.duration
+    opens_at, seed_commitment = await rounds.open_round(pool.name, closes_at)
+    pool_cache.set_schedule(pool.name, opens_at=opens_at, closes_at=closes_at)
+    schedule_end(pool, closes_at)
+
+    # Notify all users, publishing the commitment to this round's draw secret
+    message = (
+        f"{pool.emoji} The {pool.name} is now open and will close in {render.format_time_remaining(pool.duration)}! Use /{pool.command} to participate.\n"
+        f"Draw commitment: {seed_commitment}"
+    )
+    await broadcast_message(application, message)
 
-    # Notify all users
-    message = "🥈 The Silver Pool is now open and will close in 24 hours! Use /join_silver to participate."
-    await broadcast_message(context.application, message)
+async def end_pool(application, pool):
+    await end_specific_pool(application, pool, next_opening(pool))
 
-    await context.bot.send_message(chat_id=context.job.context, text="The Silver Pool is now open! Use /join_silver to participate.")
+# Jobs are stored as (action, pool key) so the persistent job store only has to serialize strings.
+# Metrics are labelled by action rather than by pool to keep their number bounded.
+pool_jobs = {
+    'start': metrics.instrument_job('start_pool', leader.leader_only(start_pool)),
+    'end': metrics.instrument_job('end_pool', leader.leader_only(end_pool)),
+}
 
-async def end_silver_pool(context):
-    global next_silver_start_time  # Removed silver_pool_open as it is unused
-    next_silver_start_time = datetime.now(timezone.utc) + timedelta(days=3)  # Opens every 3 days
-    await end_specific_pool(context, silver_pool_participants, silver_pool_amount, "Silver Pool")
+scheduler = None
+bot_application = None
 
-async def start_gold_pool(context):
-    global next_gold_end_time  # Removed gold_pool_open as it is unused
-    next_gold_end_time = datetime.now(timezone.utc) + timedelta(hours=24)  # Pool runs for 24 hours
+# Next time a pool's start job fires
+def next_opening(pool):
+    return pool.trigger.get_next_fire_time(None, datetime.now(timezone.utc))
 
-    # Notify all users
-    message = "🥇 The Gold Pool is now open and will close in 24 hours! Use /join_gold to participate."
-    await broadcast_message(context.application, message)
+async def run_pool_job(action, pool_key):
+    pool = pool_registry.by_key.get(pool_key)
+    if pool is None:
+        logging.warning(f"Skipping {action} job for unknown pool {pool_key}.")
+        return
+    await pool_jobs[action](bot_application, pool)
+
+def schedule_end(pool, closes_at):
+    scheduler.add_job(run_pool_job, DateTrigger(closes_at), args=['end', pool.key],
+                      id=f'end_{pool.key}_pool', replace_existing=True)
+
+# Scheduler jobs live in the database, so a run missed while no leader was up still
+# happens (once, however late) when the next leader starts the scheduler.
+# SQLAlchemy is only imported here: followers never load it and the leader loads it after startup.
+def create_scheduler():
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    return AsyncIOScheduler(
+        jobstores={'default': SQLAlchemyJobStore(
+            url=re.sub(r'^postgres://', 'postgresql://', db.DATABASE_URL or ''),  # SQLAlchemy rejects the postgres:// scheme
+            engine_options={'connect_args': {'sslmode': db.DB_SSLMODE}},
+        )},
+        job_defaults={'coalesce': True, 'misfire_grace_time': None},
+    )
 
-    await context.bot.send_message(chat_id=context.job.context, text="The Gold Pool is now open! Use /join_gold to participate.")
-    
-async def end_gold_pool(context):
-    global next_gold_start_time  # Removed gold_pool_open as it is unused
-    next_gold_start_time = datetime.now(timezone.utc) + timedelta(days=7)  # Opens every Sunday
-    await end_specific_pool(context, gold_pool_participants, gold_pool_amount, "Gold Pool")
-
-# Helper function to format the time remaining
-def format_time_remaining(time_remaining):
-    days, seconds = time_remaining.days, time_remaining.seconds
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    if days > 0:
-        return f"{days}d {hours}h {minutes}m"
-    elif hours > 0:
-        return f"{hours}h {minutes}m"
-    else:
-        return f"{minutes}m"
+# Start the persistent scheduler on the leader and reconcile it with the pool registry.
+# Start jobs already in the store keep their next run time (so missed runs fire on resume);
+# only new or changed definitions are (re)scheduled. Open rounds always have an end job.
+async def start_scheduler():
+    global scheduler
+    if scheduler is None:
+        scheduler = create_scheduler()
+    if scheduler.running:
+        return
+    logging.info("Starting the scheduler...")
+    scheduler.start(paused=True)
+    open_rounds = await rounds.get_open_rounds()
+    job_ids = set()
+
+    for pool in pool_registry.POOLS:
+        start_id, end_id = f'start_{pool.key}_pool', f'end_{pool.key}_pool'
+        job_ids.update((start_id, end_id))
+
+        stored = scheduler.get_job(start_id)
+        if stored is None or stored.args != ('start', pool.key) or str(stored.trigger) != str(pool.trigger):
+            stored = scheduler.add_job(run_pool_job, pool.trigger, args=['start', pool.key], id=start_id, replace_existing=True)
+        # A round that has never been given an opening time gets the next start
+        await rounds.schedule_round(pool.name, stored.next_run_time)
+
+        stored_end = scheduler.get_job(end_id)
+        closes_at = open_rounds.get(pool.name)
+        if closes_at is None:
+            if stored_end is not None:
+                stored_end.remove()
+        elif stored_end is None or not isinstance(stored_end.trigger, DateTrigger) or stored_end.args != ('end', pool.key):
+            schedule_end(pool, closes_at)
+
+    # Drop jobs of pools that were removed from the registry
+    for job in scheduler.get_jobs():
+        if job.id not in job_ids:
+            logging.info(f"Removing scheduler job {job.id}: no longer in the pool registry.")
+            job.remove()
+
+    pool_cache.invalidate()
+    scheduler.resume()
+
+# Stop the scheduler when this replica loses the lead, so only the leader's scheduler takes due jobs
+# from the shared job store. The next election creates a fresh one and reconciles it again.
+async def stop_scheduler():
+    global scheduler
+    if scheduler is not None and scheduler.running:
+        logging.info("Stopping the scheduler...")
+        scheduler.shutdown(wait=False)
+    scheduler = None
 
 # Implement the /status command
 # Updated /status command
@@ -588,194 +417,201 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     try:
-        # Fetch pool sizes from the database
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT pool_name, pool_amount FROM pools WHERE pool_name IN ('Bronze Pool', 'Silver Pool', 'Gold Pool');")
-        pools = cur.fetchall()
-        pool_sizes = {name: amount for name, amount in pools}
-
-        # Assign amounts with a fallback value of 0 if not found
-        bronze_pool_amount = pool_sizes.get('Bronze Pool', 0)
-        silver_pool_amount = pool_sizes.get('Silver Pool', 0)
-        gold_pool_amount = pool_sizes.get('Gold Pool', 0)
-
-        cur.close()
-        conn.close()
+        # Rendered from the cached snapshot; rebuilt when the pool state changes or the minute rolls over
+        status_message = await render.status_text()
 
     except Exception as e:
         logging.error(f"Database error in /status command: {e}")
         await context.bot.send_message(chat_id=chat_id, text="An error occurred while fetching pool status. Please try again later.")
         return
 
-    # Determine the status and time information for each pool
-    now = datetime.now(timezone.utc)
-
-    # Bronze Pool Status
-    bronze_status = "Open" if next_bronze_start_time <= now < next_bronze_end_time else "Closed"
-    if bronze_status == "Open":
-        time_left_bronze = format_time_remaining(next_bronze_end_time - now)
-        bronze_info = f"Closes in: {time_left_bronze}"
-    else:
-        if next_bronze_start_time:
-            time_until_bronze_open = format_time_remaining(next_bronze_start_time - now)
-            bronze_info = f"Opens in: {time_until_bronze_open}"
-        else:
-            bronze_info = "N/A"
-
-    # Silver Pool Status
-    silver_status = "Open" if next_silver_start_time <= now < next_silver_end_time else "Closed"
-    if silver_status == "Open":
-        time_left_silver = format_time_remaining(next_silver_end_time - now)
-        silver_info = f"Closes in: {time_left_silver}"
-    else:
-        if next_silver_start_time:
-            time_until_silver_open = format_time_remaining(next_silver_start_time - now)
-            silver_info = f"Opens in: {time_until_silver_open}"
-        else:
-            silver_info = "N/A"
-
-    # Gold Pool Status
-    gold_status = "Open" if next_gold_start_time <= now < next_gold_end_time else "Closed"
-    if gold_status == "Open":
-        time_left_gold = format_time_remaining(next_gold_end_time - now)
-        gold_info = f"Closes in: {time_left_gold}"
-    else:
-        if next_gold_start_time:
-            time_until_gold_open = format_time_remaining(next_gold_start_time - now)
-            gold_info = f"Opens in: {time_until_gold_open}"
-        else:
-            gold_info = "N/A"
-
-    # Create a message showing the pool status
-    status_message = (
-        f"🟢 **Pool Status** 🟢\n"
-        f"Bronze Pool: {bronze_status}, Current Size: ${bronze_pool_amount:.2f}\n    {bronze_info}\n"
-        f"Silver Pool: {silver_status}, Current Size: ${silver_pool_amount:.2f}\n    {silver_info}\n"
-        f"Gold Pool: {gold_status}, Current Size: ${gold_pool_amount:.2f}\n    {gold_info}\n"
-    )
-
     # Send the status message to the user
     await context.bot.send_message(chat_id=chat_id, text=status_message, parse_mode='Markdown')
 
-async def end_specific_pool(context, pool_participants, pool_name):
+async def end_specific_pool(application, pool, next_opens_at=None):
+    pool_name = pool.name
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Fetch the current pool amount from the database
-        cur.execute("SELECT pool_amount FROM pools WHERE pool_name = %s;", (pool_name,))
-        pool_amount = cur.fetchone()[0]
-
- # Function to select a winner and reset the pool
-        def select_winner(pool_participants, pool_amount):
-            if pool_participants:
-                winner = random.choice(pool_participants)
-                winner_chat_id = winner['chat_id']
-                prize_amount = pool_amount * (1 - bot_cut_percentage / 100)
-                success, error_message = transfer_to_winner(winner_chat_id, prize_amount)
-                if success:
-                    return winner_chat_id, prize_amount
-                else:
-                    return None, error_message
-            return None, 0
-
-        winner_chat_id, prize_amount = select_winner(pool_participants, pool_amount)
-        if winner_chat_id:
-            await context.bot.send_message(chat_id=winner_chat_id, text=f"Congratulations! You won ${prize_amount:.2f} in the {pool_name}!")
-        else:
-            await context.bot.send_message(chat_id=context.job.context, text=f"No winner selected for {pool_name} due to an error.")
-
-        # Notify users of pool reset
-        for participant in pool_participants:
-            await context.bot.send_message(chat_id=participant['chat_id'], text="The pool has been reset for the next round. Join again to participate!")
-
-        # Reset pool amount in the database
-        cur.execute("UPDATE pools SET pool_amount = 0 WHERE pool_name = %s;", (pool_name,))
-        conn.commit()
+        # Close the round first so late joins land in the next one
+        closed = await rounds.close_round(pool_name, next_opens_at)
+        if closed is None:
+            logging.error(f"Pool {pool_name} not found while ending it.")
+            return
+        round_id = closed[0]
+        pool_cache.reset_pool(pool_name, opens_at=next_opens_at)
+
+        # Draw the winners from the round's seed and queue their payouts in one transaction (the seed
+        # and result are stored with the round; a round closed but not settled is picked up by
+        # settle_unsettled_rounds), then kick the worker; it notifies the winners once paid
+        winner_chat_ids, seed_secret = await payouts.settle(pool, round_id)
+        if not winner_chat_ids:
+            logging.info(f"No participants in {pool_name} round {round_id}, no winner selected.")
+            return
+        application.create_task(payouts.drain(application.bot))
 
-        cur.close()
-        conn.close()
+        # Notify users of pool reset, streaming the round's participants through the outbound scheduler as bulk traffic
+        sent, failed = await broadcast.send_chunks(
+            application.bot,
+            rounds.iter_participants(pool_name, round_id),
+            "The pool has been reset for the next round. Join again to participate!\n"
+            f"The draw used the secret {seed_secret}, so anyone can check it against the commitment published when the round opened.",
+        )
+        logging.info(f"Sent {sent} reset notices for {pool_name} round {round_id} ({failed} failed).")
 
     except Exception as e:
         logging.error(f"Database error in end_specific_pool: {e}")
 
+# Settle rounds that were closed but never drawn and paid (the process stopped in between), then pay them out
+async def settle_unsettled_rounds(application):
+    try:
+        for pool_name, round_id in await payouts.unsettled_rounds():
+            pool = pool_registry.by_name.get(pool_name)
+            if pool is None:
+                logging.error(f"{pool_name} round {round_id} is not settled, but the pool is no longer configured.")
+                continue
+            winner_chat_ids, _ = await payouts.settle(pool, round_id)
+            logging.info(f"Settled {pool_name} round {round_id} after a restart: winners {winner_chat_ids}.")
+        await payouts.drain(application.bot)
+    except Exception as e:
+        logging.error(f"Database error while settling closed rounds: {e}")
+
 # Command to show all available commands
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    help_text = (
-        "Here are the available commands:\n"
-        "/start - Start interacting with the bot and see basic instructions.\n"
-        "/rules - Learn how the lucky draw pools work, including entry fees and pool timings.\n"
-        "/join_bronze - Join the Bronze Pool ($10 entry fee).\n"
-        "/join_silver - Join the Silver Pool ($25 entry fee).\n"
-        "/join_gold - Join the Gold Pool ($50 entry fee).\n"
-        "/players - View the number of participants in each pool.\n"
-        "/my_info - See your participation status in the pools.\n"
-        "/pool_size - View the current size of each pool in dollars.\n"
-        "/status - Check the status of each pool, including whether they are open or closed, the current size, and the time left until they close or reopen.\n"
-        "/help - Display this list of commands with their descriptions.\n"
-        "/set_wallet - Set a wallet where the winning amount will be transferred"
-    )
-    await context.bot.send_message(chat_id=chat_id, text=help_text)
+    await context.bot.send_message(chat_id=chat_id, text=render.HELP_TEXT)
+
+# Command name -> (callback, keyboard button that does the same or None). The CommandHandlers
+# and the button dispatch table are both built from this registry.
+COMMANDS = {
+    'start': (start_command, None),
+    'set_wallet': (set_wallet, "👛 Set Wallet"),
+    'rules': (rules, "📜 Rules"),
+    'status': (status, "📊 Status"),
+    **{pool.command: (join_callback(pool), pool.button) for pool in pool_registry.POOLS},
+    'players': (players, "👥 Players"),
+    'my_info': (my_info, "ℹ️ My Info"),
+    'pool_size': (pool_size, "💰 Pool Size"),
+    'help': (help_command, "🆘 Help"),
+}
+# Commands that are throttled like their buttons
+THROTTLED_COMMANDS = {pool.command for pool in pool_registry.POOLS}
+BUTTONS = {button: callback for callback, button in COMMANDS.values() if button}
 
-# Set up the bot
 # Set up the bot
 from telegram.ext import MessageHandler, filters
 
-def main():
-    global next_bronze_start_time, next_silver_start_time, next_gold_start_time
+# Open the database pool before the first update arrives
+async def post_init(application):
+    # Time spent connecting the bot to Telegram (getMe) before this hook runs
+    startup.mark('bot_initialize')
+
+    async def warm_up_database():
+        await asyncio.get_running_loop().run_in_executor(None, db.init_pool)
+        await migrations.migrate()
+        await rounds.ensure_pools(pool_registry.POOL_NAMES)
+
+    # Open the database pool and the CryptoBot connection concurrently; also start the
+    # event-loop lag monitor and the /metrics endpoint (if METRICS_PORT is set)
+    await asyncio.gather(metrics.start(), warm_up_database(), cryptobot.warm_up())
+    startup.mark('warm_up')
+
+    # Whenever this replica becomes leader (including on boot), run the pool jobs and catch up on
+    # work interrupted by a restart or a failover
+    async def take_over():
+        await start_scheduler()
+        # Catch-up work is cancelled if the lead is lost (the next leader runs it again). Pending
+        # invoices are reconciled in one batched pass instead of waiting for the poll interval.
+        leader.create_task(payments.reconcile_pending_invoices(application.bot))
+        leader.create_task(broadcast.resume_broadcasts(application.bot))
+        leader.create_task(settle_unsettled_rounds(application))
+    leader.on_elected(take_over)
+    leader.on_demoted(stop_scheduler)
+    await leader.start()
+
+    # Follow cache invalidations from every process (the cache is bypassed until this is listening)
+    await user_cache.start()
+
+    # Receive CryptoBot invoice_paid events if a webhook port is configured
+    if webhook.is_enabled():
+        await webhook.start(application.bot)
+
+    startup.mark('post_init')
+    startup.report()
+
+async def post_shutdown(application):
+    await stop_scheduler()
+    await leader.stop()
+    await user_cache.stop()
+    await webhook.stop()
+    # Write out users registered since the last flush
+    await registration.flush()
+    await cryptobot.close()
+    await metrics.stop()
+    db.close_pool()
 
+def main():
+    global bot_application
+    startup.mark('imports')
     logging.info("Setting up the bot application...")
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
-    # Set up the scheduler
-    scheduler = AsyncIOScheduler()
-    
-    logging.info("Setting up scheduled jobs for pools...")
-
-    # Schedule pool start and end times
-    # Bronze Pool
-    bronze_trigger = CronTrigger(hour=0, minute=0, timezone='Asia/Kolkata')
-    scheduler.add_job(start_bronze_pool, bronze_trigger, args=[application])
-    scheduler.add_job(end_bronze_pool, CronTrigger(hour=23, minute=59, timezone='Asia/Kolkata'), args=[application])
-    next_bronze_start_time = bronze_trigger.get_next_fire_time(None, datetime.now(timezone.utc))
-
-    # Silver Pool
-    silver_trigger = CronTrigger(hour=0, minute=0, timezone='Asia/Kolkata', day='*/3')
-    scheduler.add_job(start_silver_pool, silver_trigger, args=[application])
-    scheduler.add_job(end_silver_pool, CronTrigger(hour=23, minute=59, timezone='Asia/Kolkata', day='*/3'), args=[application])
-    next_silver_start_time = silver_trigger.get_next_fire_time(None, datetime.now(timezone.utc))
-
-    # Gold Pool
-    gold_trigger = CronTrigger(day_of_week='sun', hour=0, minute=0, timezone='Asia/Kolkata')
-    scheduler.add_job(start_gold_pool, gold_trigger, args=[application])
-    scheduler.add_job(end_gold_pool, CronTrigger(day_of_week='sun', hour=23, minute=59, timezone='Asia/Kolkata'), args=[application])
-    next_gold_start_time = gold_trigger.get_next_fire_time(None, datetime.now(timezone.utc))
-
-    logging.info("Starting the scheduler...")
-    scheduler.start()
+    # Production runtime: uvloop's faster event loop when it is installed
+    if USE_UVLOOP:
+        try:
+            import uvloop
+        except ImportError:
+            logging.info("uvloop is not installed, using the default asyncio event loop.")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Updates from different chats are handled concurrently, each chat's in order
+    application = bot_application = (
+        Application.builder().token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(updates.processor)
+        # Every message to a chat goes through the prioritized outbound scheduler
+        .rate_limiter(outbox.scheduler)
+        .post_init(post_init).post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Command handlers
-    application.add_handler(CommandHandler('start', start_command))
-    application.add_handler(CommandHandler('set_wallet', set_wallet))
-    application.add_handler(CommandHandler('join_bronze', lambda u, c: handle_join(u, c, bronze_entry_fee, "Bronze Pool")))
-    application.add_handler(CommandHandler('join_silver', lambda u, c: handle_join(u, c, silver_entry_fee, "Silver Pool")))
-    application.add_handler(CommandHandler('join_gold', lambda u, c: handle_join(u, c, gold_entry_fee, "Gold Pool")))
-    # Other command handlers
-    application.add_handler(CommandHandler('rules', rules))
-    application.add_handler(CommandHandler('players', players))
-    application.add_handler(CommandHandler('my_info', my_info))
-    application.add_handler(CommandHandler('pool_size', pool_size))
-    application.add_handler(CommandHandler('help', help_command))
-    application.add_handler(CommandHandler('status', status))
+    # Command handlers, from the same registry as the keyboard buttons
+    for command, (callback, button) in COMMANDS.items():
+        if command in THROTTLED_COMMANDS:
+            callback = throttled_command(callback)
+        application.add_handler(CommandHandler(command, callback))
 
     # Add a message handler for the custom keyboard buttons
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, button_handler))
 
+    # Poll all pending invoices with one batched worker (only a slow fallback sweep when webhooks are on)
+    poll_interval = webhook.FALLBACK_POLL_INTERVAL if webhook.is_enabled() else payments.PAYMENT_POLL_INTERVAL
+    application.job_queue.run_repeating(metrics.instrument_job('check_payment_status', check_payment_status), interval=poll_interval, first=poll_interval)
+
+    # Drain the payout queue
+    application.job_queue.run_repeating(metrics.instrument_job('process_payouts', process_payouts), interval=payouts.PAYOUT_POLL_INTERVAL, first=payouts.PAYOUT_POLL_INTERVAL)
+
+    # Archive finished rounds
+    application.job_queue.run_repeating(metrics.instrument_job('archive_history', archive_history), interval=archive.ARCHIVE_INTERVAL, first=archive.ARCHIVE_INTERVAL)
+
+    # Record latency and errors of every command and button handler
+    metrics.instrument_application(application)
+
+    # Runs after every other handler group, to report when the first update was handled
+    application.add_handler(TypeHandler(Update, startup.on_update_handled), group=1000)
+    startup.mark('application')
+
     logging.info("Starting Lucky Draw Pool bot...")
-    application.run_polling()
+    if TELEGRAM_WEBHOOK_URL:
+        application.run_webhook(
+            listen=TELEGRAM_WEBHOOK_LISTEN,
+            port=TELEGRAM_WEBHOOK_PORT,
+            url_path=TELEGRAM_WEBHOOK_PATH,
+            webhook_url=TELEGRAM_WEBHOOK_URL.rstrip('/') + '/' + TELEGRAM_WEBHOOK_PATH,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+        )
+    else:
+        if leader.MULTI_REPLICA:
+            logging.warning("MULTI_REPLICA is set but TELEGRAM_WEBHOOK_URL is not; only one replica can poll for updates.")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
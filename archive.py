@@ -0,0 +1,100 @@
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+from psycopg2 import sql
+import db
+import metrics
+
+# pool_participants, invoices and transfers are range-partitioned on archived_month. Live rows have
+# archived_month = 'infinity' and sit in the small <table>_active partition; the archival job moves
+# finished rows into one cold partition per month (<table>_yYYYYmMM). Hot-path queries filter on
+# archived_month = 'infinity' so they only ever touch the active partitions.
+
+# Rows are archived once their round closed (participants) or they were settled (invoices, transfers)
+# at least this many days ago. Entries of a round that still has to be drawn stay active, since the
+# draw only reads the active partition.
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '7'))
+# How often the leader runs the archival job
+ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', '3600'))
+# Rows moved per transaction
+ARCHIVE_BATCH_SIZE = 5000
+# Optional tablespace for the monthly cold partitions
+ARCHIVE_TABLESPACE = os.getenv('ARCHIVE_TABLESPACE')
+
+# table -> (key column, query for its archivable rows as (key, month))
+_ARCHIVABLE = {
+    'pool_participants': ('id', """
+        SELECT pp.id, date_trunc('month', r.closes_at)::date
+        FROM pool_participants pp
+        JOIN pool_rounds r ON r.pool_name = pp.pool_name AND r.round_id = pp.round_id
+        WHERE pp.archived_month = 'infinity' AND r.state = 'closed' AND r.settled_at IS NOT NULL AND r.closes_at < %s
+        LIMIT %s;
+    """),
+    'invoices': ('invoice_id', """
+        SELECT invoice_id, date_trunc('month', creation_time)::date FROM invoices
+        WHERE archived_month = 'infinity' AND status <> 'pending' AND creation_time < %s
+        LIMIT %s;
+    """),
+    'transfers': ('id', """
+        SELECT id, date_trunc('month', timestamp)::date FROM transfers
+        WHERE archived_month = 'infinity' AND timestamp < %s
+        LIMIT %s;
+    """),
+}
+
+_stats = {'runs': 0, 'archived': 0, 'partitions_created': 0}
+
+def _ensure_partition(cur, table, month):
+    name = f"{table}_y{month.year}m{month.month:02d}"
+    next_month = (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+    if cur.fetchone()[0]:
+        return
+    query = sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(sql.Identifier(name), sql.Identifier(table))
+    if ARCHIVE_TABLESPACE:
+        query += sql.SQL(" TABLESPACE {}").format(sql.Identifier(ARCHIVE_TABLESPACE))
+    cur.execute(query, (month, next_month))
+    _stats['partitions_created'] += 1
+    logging.info(f"Created archive partition {name}.")
+
+# Move one batch of a table's finished rows into their monthly partitions (runs inside one transaction).
+# Returns the number of rows moved.
+def _archive_batch(cur, table, cutoff):
+    key_column, due_query = _ARCHIVABLE[table]
+    cur.execute(due_query, (cutoff, ARCHIVE_BATCH_SIZE))
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+    for month in sorted({month for _, month in rows}):
+        _ensure_partition(cur, table, month)
+    # Changing the partition key moves each row into its cold partition
+    cur.execute(sql.SQL("""
+        UPDATE {table} SET archived_month = due.month
+        FROM unnest(%s::bigint[], %s::date[]) AS due (key, month)
+        WHERE {table}.{key} = due.key AND {table}.archived_month = 'infinity';
+    """).format(table=sql.Identifier(table), key=sql.Identifier(key_column)),
+        ([key for key, _ in rows], [month for _, month in rows]))
+    return cur.rowcount
+
+# Archive everything that is due, one batch per transaction so the active partitions are
+# never locked for long
+async def archive_finished_rows():
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    moved = {}
+    for table in _ARCHIVABLE:
+        moved[table] = 0
+        while True:
+            count = await db.run_transaction(_archive_batch, table, cutoff)
+            moved[table] += count
+            if count < ARCHIVE_BATCH_SIZE:
+                break
+    _stats['runs'] += 1
+    _stats['archived'] += sum(moved.values())
+    if any(moved.values()):
+        logging.info(f"Archived rows older than {ARCHIVE_AFTER_DAYS} days: {moved}")
+    return moved
+
+def get_stats():
+    return dict(_stats)
+
+metrics.register_collector(lambda: {(f'archive_{name}', None): value for name, value in get_stats().items()})
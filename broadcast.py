@@ -0,0 +1,103 @@
+import os
+import time
+import asyncio
+import logging
+from psycopg2.extras import execute_values
+from telegram.error import RetryAfter, Forbidden, BadRequest, TelegramError
+import db
+import outbox
+
+# Recipients loaded (and checkpointed) per round trip
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '500'))
+BROADCAST_MAX_RETRIES = 3
+
+def _create_broadcast(cur, message):
+    cur.execute("INSERT INTO broadcasts (message) VALUES (%s) RETURNING broadcast_id;", (message,))
+    return cur.fetchone()[0]
+
+# Keyset pagination over users, so only one chunk of chat_ids is in memory at a time
+def _fetch_chunk(cur, after_chat_id, limit):
+    if after_chat_id is None:
+        cur.execute("SELECT chat_id FROM users ORDER BY chat_id LIMIT %s;", (limit,))
+    else:
+        cur.execute("SELECT chat_id FROM users WHERE chat_id > %s ORDER BY chat_id LIMIT %s;", (after_chat_id, limit))
+    return [row[0] for row in cur.fetchall()]
+
+# Store the per-recipient results and move the resume checkpoint forward in one transaction
+def _record_chunk(cur, broadcast_id, results, last_chat_id):
+    execute_values(cur, """
+        INSERT INTO broadcast_deliveries (broadcast_id, chat_id, status) VALUES %s
+        ON CONFLICT (broadcast_id, chat_id) DO UPDATE SET status = EXCLUDED.status;
+    """, [(broadcast_id, chat_id, status) for chat_id, status in results])
+    sent = sum(1 for _, status in results if status == 'sent')
+    cur.execute("""
+        UPDATE broadcasts SET last_chat_id = %s, sent = sent + %s, failed = failed + %s
+        WHERE broadcast_id = %s;
+    """, (last_chat_id, sent, len(results) - sent, broadcast_id))
+
+# Bulk messages wait behind interactive and transactional ones in the outbound scheduler,
+# which also applies the rate limits and retry_after pauses
+async def send_with_retry(bot, chat_id, message):
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        try:
+            await bot.send_message(chat_id=chat_id, text=message, rate_limit_args={'priority': outbox.BULK})
+            return 'sent'
+        except RetryAfter:
+            # Still flooded after the scheduler's own retries
+            return 'failed'
+        except (Forbidden, BadRequest):
+            # The user blocked the bot or the chat no longer exists
+            return 'failed'
+        except TelegramError as e:
+            logging.error(f"Failed to send broadcast to {chat_id}: {e}. Attempt {attempt + 1} of {BROADCAST_MAX_RETRIES}")
+            await asyncio.sleep(2 ** attempt)
+    return 'failed'
+
+# Send one message to an async stream of chat_id chunks through the outbound scheduler, without
+# recording deliveries. Only one chunk is in flight at a time, so memory stays constant.
+async def send_chunks(bot, chunks, message):
+    sent = failed = 0
+    async for chat_ids in chunks:
+        statuses = await asyncio.gather(*[send_with_retry(bot, chat_id, message) for chat_id in chat_ids])
+        chunk_sent = statuses.count('sent')
+        sent += chunk_sent
+        failed += len(statuses) - chunk_sent
+    return sent, failed
+
+# Send (or resume) a broadcast chunk by chunk through the outbound scheduler
+async def run_broadcast(bot, broadcast_id, message, last_chat_id=None):
+    started = time.monotonic()
+    sent = failed = 0
+
+    while True:
+        # Recipients may come from a read replica
+        chat_ids = await db.run_read_only(_fetch_chunk, last_chat_id, BROADCAST_CHUNK_SIZE)
+        if not chat_ids:
+            break
+
+        statuses = await asyncio.gather(*[send_with_retry(bot, chat_id, message) for chat_id in chat_ids])
+        results = list(zip(chat_ids, statuses))
+        last_chat_id = chat_ids[-1]
+        await db.run_transaction(_record_chunk, broadcast_id, results, last_chat_id)
+
+        chunk_sent = statuses.count('sent')
+        sent += chunk_sent
+        failed += len(statuses) - chunk_sent
+
+    await db.execute("UPDATE broadcasts SET status = 'finished', finished_at = now() WHERE broadcast_id = %s;", (broadcast_id,))
+
+    elapsed = time.monotonic() - started
+    rate = sent / elapsed if elapsed > 0 else 0.0
+    logging.info(f"Broadcast {broadcast_id} finished: {sent} sent, {failed} failed in {elapsed:.1f}s ({rate:.1f} msg/s)")
+    return {'broadcast_id': broadcast_id, 'sent': sent, 'failed': failed, 'elapsed': elapsed, 'rate': rate}
+
+async def broadcast(bot, message):
+    broadcast_id = await db.run_transaction(_create_broadcast, message)
+    return await run_broadcast(bot, broadcast_id, message)
+
+# Continue broadcasts that were interrupted by a crash or restart
+async def resume_broadcasts(bot):
+    unfinished = await db.fetchall("SELECT broadcast_id, message, last_chat_id FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id;")
+    for broadcast_id, message, last_chat_id in unfinished:
+        logging.info(f"Resuming broadcast {broadcast_id} after chat_id {last_chat_id}")
+        await run_broadcast(bot, broadcast_id, message, last_chat_id)
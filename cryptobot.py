@@ -0,0 +1,116 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import httpx
+import metrics
+
+# CryptoBot API endpoint (can be pointed at a local stub server for testing)
+CRYPTBOT_API_URL = os.getenv('CRYPTBOT_API_URL', 'https://pay.crypt.bot/api/')
+CRYPTBOT_API_TOKEN = os.getenv('CRYPTBOT_API_TOKEN')
+
+# HTTP client configuration
+CRYPTBOT_TIMEOUT = float(os.getenv('CRYPTBOT_TIMEOUT', '10'))
+CRYPTBOT_MAX_CONNECTIONS = int(os.getenv('CRYPTBOT_MAX_CONNECTIONS', '20'))
+CRYPTBOT_MAX_KEEPALIVE = int(os.getenv('CRYPTBOT_MAX_KEEPALIVE', '10'))
+
+# Circuit breaker configuration
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CRYPTBOT_CIRCUIT_FAILURES', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CRYPTBOT_CIRCUIT_RESET', '30'))
+
+class CryptoBotError(Exception):
+    pass
+
+class CircuitOpenError(CryptoBotError):
+    pass
+
+_client = None
+
+# Circuit breaker state
+_consecutive_failures = 0
+_circuit_opened_at = None
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=CRYPTBOT_API_URL,
+            headers={'Content-Type': 'application/json', 'Crypto-Pay-API-Token': CRYPTBOT_API_TOKEN or ''},
+            timeout=CRYPTBOT_TIMEOUT,
+            limits=httpx.Limits(max_connections=CRYPTBOT_MAX_CONNECTIONS,
+                                max_keepalive_connections=CRYPTBOT_MAX_KEEPALIVE),
+        )
+    return _client
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# Per-endpoint latency histograms
+def _observe(method, elapsed, error=False):
+    metrics.observe('cryptobot_request_seconds', elapsed, {'method': method})
+    if error:
+        metrics.inc('cryptobot_request_errors_total', {'method': method})
+
+def _check_circuit():
+    global _circuit_opened_at
+    if _circuit_opened_at is None:
+        return
+    if time.monotonic() - _circuit_opened_at < CIRCUIT_RESET_TIMEOUT:
+        raise CircuitOpenError("CryptoBot circuit breaker is open")
+    # Half-open: let this request through as a trial
+    _circuit_opened_at = None
+
+def _record_success():
+    global _consecutive_failures
+    _consecutive_failures = 0
+
+def _record_failure():
+    global _consecutive_failures, _circuit_opened_at
+    _consecutive_failures += 1
+    if _consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+        logging.error(f"CryptoBot API failed {_consecutive_failures} times in a row, opening circuit for {CIRCUIT_RESET_TIMEOUT}s.")
+        _circuit_opened_at = time.monotonic()
+
+# Call a CryptoBot API method and return the decoded JSON body.
+# Network errors, 429 and 5xx responses are retried with jittered exponential backoff;
+# other responses (including {"ok": false} errors) are returned to the caller as-is.
+async def call(method, payload=None, max_retries=3):
+    _check_circuit()
+    client = get_client()
+
+    for attempt in range(max_retries):
+        started = time.monotonic()
+        try:
+            response = await client.post(method, json=payload or {})
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            _observe(method, time.monotonic() - started)
+            _record_success()
+            return response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            _observe(method, time.monotonic() - started, error=True)
+            logging.error(f"CryptoBot {method} request failed: {e}. Attempt {attempt + 1} of {max_retries}")
+            if attempt + 1 < max_retries:
+                await asyncio.sleep(random.uniform(0, 2 ** attempt))
+
+    _record_failure()
+    raise CryptoBotError(f"CryptoBot {method} failed after {max_retries} attempts")
+
+# Open the keep-alive connection (DNS, TCP and TLS) before the first invoice needs it
+async def warm_up():
+    try:
+        await call('getMe', max_retries=1)
+    except CryptoBotError as e:
+        logging.warning(f"Could not warm up the CryptoBot connection: {e}")
+
+def get_stats():
+    return {
+        'consecutive_failures': _consecutive_failures,
+        'circuit_open': _circuit_opened_at is not None,
+    }
+
+metrics.register_collector(lambda: {(f'cryptobot_{name}', None): int(value) for name, value in get_stats().items()})
@@ -0,0 +1,335 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+import metrics
+
+# Set up the database connection
+DATABASE_URL = os.getenv('DATABASE_URL')
+DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+
+# Pool configuration
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))
+# Connections idle for longer than this are pinged before being handed out
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_HEALTH_CHECK_INTERVAL', '30'))
+
+# Read replicas (comma-separated URLs) for read-only queries; all reads go to the primary if unset
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv('DB_REPLICA_POOL_MAX_SIZE', str(DB_POOL_MAX_SIZE)))
+# Replicas lagging further behind than this many seconds are skipped
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', '2'))
+# How often a replica's lag is measured; a replica that failed is skipped for this long
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '5'))
+
+# Open a standalone connection outside the pool (for session-level state such as advisory locks)
+def connect_dedicated():
+    conn = psycopg2.connect(
+        DATABASE_URL,
+        sslmode=DB_SSLMODE,
+        options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}',
+    )
+    conn.autocommit = True
+    return conn
+
+class ConnectionPool:
+    def __init__(self, name, url, min_size, max_size):
+        self.name = name
+        self.url = url
+        self.min_size = min_size
+        self.max_size = max_size
+        # Idle connections (most recently used last) and the number of connections currently open
+        self._idle = []
+        self._open_count = 0
+        self._initialized = False
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._last_used = {}
+        # psycopg2 is blocking, so every query runs on this executor. It has exactly as many
+        # workers as the pool may open connections, so a worker never has to wait for one.
+        self.executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix=f'db-{name}')
+        # Acquire-latency metrics
+        self.stats = {
+            'acquired': 0,
+            'acquire_time_total': 0.0,
+            'acquire_time_max': 0.0,
+            'health_check_failures': 0,
+            'connections_opened': 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            self.url,
+            sslmode=DB_SSLMODE,
+            options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}',
+        )
+        self._last_used[id(conn)] = time.monotonic()
+        with self._pool_lock:
+            self._open_count += 1
+        with self._stats_lock:
+            self.stats['connections_opened'] += 1
+        return conn
+
+    def init(self):
+        if self._initialized:
+            return
+        logging.info(f"Opening database pool {self.name} (min={self.min_size}, max={self.max_size})...")
+        # Open the initial connections in parallel on the query executor
+        for conn in self.executor.map(lambda _: self._connect(), range(self.min_size - len(self._idle))):
+            with self._pool_lock:
+                self._idle.append(conn)
+        self._initialized = True
+        logging.info(f"Database pool {self.name} established successfully.")
+
+    def close(self):
+        with self._pool_lock:
+            while self._idle:
+                self._idle.pop().close()
+            self._open_count = 0
+            self._last_used.clear()
+            self._initialized = False
+
+    # Check whether a connection that sat idle is still usable
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < DB_HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _getconn(self):
+        with self._pool_lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        with self._pool_lock:
+            self._open_count -= 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _acquire(self, queued_at):
+        conn = self._getconn()
+        while not self._is_healthy(conn):
+            logging.warning(f"Discarding broken database connection from pool {self.name}.")
+            with self._stats_lock:
+                self.stats['health_check_failures'] += 1
+            self._discard(conn)
+            conn = self._getconn()
+
+        waited = time.monotonic() - queued_at
+        metrics.observe('db_acquire_seconds', waited, {'pool': self.name})
+        with self._stats_lock:
+            self.stats['acquired'] += 1
+            self.stats['acquire_time_total'] += waited
+            self.stats['acquire_time_max'] = max(self.stats['acquire_time_max'], waited)
+        return conn
+
+    # Connections stay open after use (up to max_size, enforced by the executor)
+    def _release(self, conn, broken=False):
+        if broken or conn.closed:
+            self._discard(conn)
+            return
+        self._last_used[id(conn)] = time.monotonic()
+        with self._pool_lock:
+            self._idle.append(conn)
+
+    # Runs fn(cur, *args) inside a single transaction on a pooled connection
+    def _run_in_transaction(self, queued_at, fn, args):
+        conn = self._acquire(queued_at)
+        started = time.monotonic()
+        try:
+            with conn.cursor() as cur:
+                result = fn(cur, *args)
+            conn.commit()
+        except Exception:
+            metrics.inc('db_errors_total', {'query': fn.__name__})
+            broken = conn.closed != 0
+            if not broken:
+                conn.rollback()
+            self._release(conn, broken)
+            raise
+        finally:
+            metrics.observe('db_query_seconds', time.monotonic() - started, {'query': fn.__name__})
+        self._release(conn)
+        return result
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run_in_transaction, time.monotonic(), fn, args)
+
+    def get_stats(self):
+        acquired = self.stats['acquired']
+        return {
+            **self.stats,
+            'acquire_time_avg': self.stats['acquire_time_total'] / acquired if acquired else 0.0,
+            'connections_open': self._open_count,
+            'connections_idle': len(self._idle),
+            'pool_min_size': self.min_size,
+            'pool_max_size': self.max_size,
+        }
+
+# Raised instead of running a read on a replica that is too far behind
+class ReplicaLagging(Exception):
+    pass
+
+# A hot standby. Its replay lag is measured on the connection a read is about to use, at most once
+# per DB_REPLICA_CHECK_INTERVAL; a replica that lags too much or fails is skipped until the next check
+# is due, and the next read then measures it again.
+class ReplicaPool(ConnectionPool):
+    def __init__(self, name, url, min_size, max_size):
+        super().__init__(name, url, min_size, max_size)
+        self.lag = 0.0
+        self.checked_at = 0.0
+        self.down_until = 0.0
+
+    def available(self):
+        now = time.monotonic()
+        if now < self.down_until:
+            return False
+        # A stale measurement is retaken by the read (_acquire), so a replica that caught up is used again
+        return self.lag <= DB_REPLICA_MAX_LAG or now - self.checked_at >= DB_REPLICA_CHECK_INTERVAL
+
+    def _acquire(self, queued_at):
+        conn = super()._acquire(queued_at)
+        now = time.monotonic()
+        if now - self.checked_at < DB_REPLICA_CHECK_INTERVAL:
+            return conn
+        try:
+            with conn.cursor() as cur:
+                # Zero while the replica has replayed everything it received (an idle primary writes no WAL)
+                cur.execute("""
+                    SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                         ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0);
+                """)
+                self.lag = float(cur.fetchone()[0])
+            conn.rollback()
+        except psycopg2.Error:
+            self._release(conn, broken=True)
+            raise
+        self.checked_at = now
+        if self.lag > DB_REPLICA_MAX_LAG:
+            self._release(conn)
+            logging.warning(f"Replica {self.name} is {self.lag:.1f}s behind, reading from the primary.")
+            raise ReplicaLagging(self.name)
+        return conn
+
+    def mark_down(self, error):
+        logging.warning(f"Replica {self.name} failed ({str(error).strip()}), reading from the primary for {DB_REPLICA_CHECK_INTERVAL:g}s.")
+        self.down_until = time.monotonic() + DB_REPLICA_CHECK_INTERVAL
+        # Measure the lag again before the next read
+        self.checked_at = 0.0
+
+_primary = ConnectionPool('primary', DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)
+_replicas = [ReplicaPool(f'replica{i}', url, DB_POOL_MIN_SIZE, DB_REPLICA_POOL_MAX_SIZE)
+             for i, url in enumerate(DATABASE_REPLICA_URLS, 1)]
+_next_replica = 0
+_routing_stats = {'replica_reads': 0, 'primary_reads': 0, 'replica_fallbacks': 0}
+
+def init_pool():
+    _primary.init()
+    for replica in _replicas:
+        try:
+            replica.init()
+        except psycopg2.Error as e:
+            replica.mark_down(e)
+
+def close_pool():
+    _primary.close()
+    for replica in _replicas:
+        replica.close()
+
+async def run_transaction(fn, *args):
+    return await _primary.run(fn, *args)
+
+# Next available replica (round robin), or None if the read has to go to the primary
+def _pick_replica():
+    global _next_replica
+    for _ in range(len(_replicas)):
+        replica = _replicas[_next_replica % len(_replicas)]
+        _next_replica += 1
+        if replica.available():
+            return replica
+    return None
+
+# Runs a read-only fn(cur, *args) on a replica when one is available and caught up, otherwise (or if
+# the replica fails) on the primary. Only for reads that can tolerate DB_REPLICA_MAX_LAG of staleness.
+async def run_read_only(fn, *args):
+    replica = _pick_replica() if _replicas else None
+    if replica is not None:
+        try:
+            result = await replica.run(fn, *args)
+            _routing_stats['replica_reads'] += 1
+            return result
+        except ReplicaLagging:
+            pass
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            replica.mark_down(e)
+        _routing_stats['replica_fallbacks'] += 1
+    _routing_stats['primary_reads'] += 1
+    return await _primary.run(fn, *args)
+
+def _fetchone(cur, query, params):
+    cur.execute(query, params)
+    return cur.fetchone()
+
+def _fetchall(cur, query, params):
+    cur.execute(query, params)
+    return cur.fetchall()
+
+def _execute(cur, query, params):
+    cur.execute(query, params)
+    return cur.rowcount
+
+# read_only=True lets a replica answer (see run_read_only)
+async def fetchone(query, params=None, read_only=False):
+    if read_only:
+        return await run_read_only(_fetchone, query, params)
+    return await run_transaction(_fetchone, query, params)
+
+async def fetchall(query, params=None, read_only=False):
+    if read_only:
+        return await run_read_only(_fetchall, query, params)
+    return await run_transaction(_fetchall, query, params)
+
+async def execute(query, params=None):
+    return await run_transaction(_execute, query, params)
+
+def _collect():
+    gauges = {
+        ('db_connections_open', None): _primary._open_count,
+        ('db_connections_idle', None): len(_primary._idle),
+        ('db_connections_opened', None): _primary.stats['connections_opened'],
+        ('db_health_check_failures', None): _primary.stats['health_check_failures'],
+    }
+    for replica in _replicas:
+        gauges[(f'db_{replica.name}_lag_seconds', None)] = replica.lag
+        gauges[(f'db_{replica.name}_available', None)] = int(replica.available())
+        gauges[(f'db_{replica.name}_connections_open', None)] = replica._open_count
+    for name, value in _routing_stats.items():
+        gauges[(f'db_{name}', None)] = value
+    return gauges
+
+metrics.register_collector(_collect)
+
+def get_stats():
+    return {
+        **_primary.get_stats(),
+        **_routing_stats,
+        'replicas': {replica.name: dict(replica.get_stats(), lag=replica.lag, available=replica.available())
+                     for replica in _replicas},
+    }
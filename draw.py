@@ -0,0 +1,116 @@
+import hashlib
+import secrets
+import logging
+
+# Winner draws can be recomputed by anyone from what is stored with each round in pool_rounds:
+#   seed    = sha256("<seed_secret>:<pool_name>:<round_id>:<entries digest>") as hex, where the entries
+#             digest is the hex sha256 of the round's invoice ids, sorted numerically and comma-separated
+#   tickets = the sha256(seed || 8-byte big-endian counter) stream for counter 0, 1, ..., each value
+#             mapped to [0, total_tickets) by rejection sampling (see ticket_stream)
+#   winners = the participant whose ticket range [first_ticket, first_ticket + tickets) holds each
+#             ticket, skipping participants that have already won, until enough winners are found
+# The secret's sha256 (seed_commitment) is announced when a round opens and the secret when it closes.
+# Players cannot predict or steer the seed, and the operator cannot swap the secret once the round
+# opened. The operator does know the secret while the round runs, though, and could still steer the
+# seed by adding entries of its own; the commitment only proves the draw was computed as described.
+# Participants hold one ticket per cent paid, so entries are weighted by the amount paid.
+
+# A new round secret and the commitment that is published for it
+def new_secret():
+    secret = secrets.token_hex(32)
+    return secret, commitment(secret)
+
+def commitment(secret):
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+def entries_digest(invoice_ids):
+    return hashlib.sha256(','.join(str(invoice_id) for invoice_id in sorted(invoice_ids)).encode()).hexdigest()
+
+def make_seed(secret, pool_name, round_id, digest):
+    return hashlib.sha256(f"{secret}:{pool_name}:{round_id}:{digest}".encode()).hexdigest()
+
+# Endless stream of uniformly distributed ticket numbers derived from the seed
+def ticket_stream(seed, total_tickets):
+    seed_bytes = bytes.fromhex(seed)
+    # Values at or above the largest multiple of total_tickets are rejected to avoid modulo bias
+    limit = 2 ** 256 - 2 ** 256 % total_tickets
+    counter = 0
+    while True:
+        value = int.from_bytes(hashlib.sha256(seed_bytes + counter.to_bytes(8, 'big')).digest(), 'big')
+        counter += 1
+        if value < limit:
+            yield value % total_tickets
+
+# Recompute a stored draw offline from the revealed secret and the round's entries, given as
+# (invoice_id, chat_id, first_ticket, tickets). Returns the seed, the winning tickets and the winners.
+def recompute(secret, pool_name, round_id, entries, winner_count=1):
+    entries = sorted(entries, key=lambda entry: entry[2])
+    seed = make_seed(secret, pool_name, round_id, entries_digest(entry[0] for entry in entries))
+    total_tickets = sum(entry[3] for entry in entries)
+    participants = len({entry[1] for entry in entries})
+    winners, winning_tickets = [], []
+    if total_tickets == 0:
+        return seed, winning_tickets, winners
+    for ticket in ticket_stream(seed, total_tickets):
+        chat_id = next(entry[1] for entry in reversed(entries) if entry[2] <= ticket)
+        if chat_id not in winners:
+            winners.append(chat_id)
+            winning_tickets.append(ticket)
+            if len(winners) == min(winner_count, participants):
+                return seed, winning_tickets, winners
+
+# Draw up to winner_count distinct winners of a closed round and store the result (runs inside the
+# transaction that settles the round, see payouts.settle_round). Each ticket is resolved with one lookup on the (pool_name, round_id, first_ticket)
+# index, so the round's participants are never loaded. Drawing a round twice returns the stored result.
+# A round's entries stay in the active partition until it is settled (see archive.py).
+def draw_round(cur, pool_name, round_id, winner_count):
+    cur.execute("""
+        SELECT seed_secret, winner_chat_ids FROM pool_rounds
+        WHERE pool_name = %s AND round_id = %s
+        FOR UPDATE;
+    """, (pool_name, round_id))
+    row = cur.fetchone()
+    if row is None:
+        return [], None
+    secret, stored_winners = row
+    if stored_winners is not None:
+        return stored_winners, secret
+
+    cur.execute("""
+        SELECT COALESCE(SUM(tickets), 0)::bigint, COUNT(DISTINCT chat_id),
+               encode(sha256(convert_to(string_agg(invoice_id::text, ',' ORDER BY invoice_id), 'UTF8')), 'hex')
+        FROM pool_participants
+        WHERE pool_name = %s AND round_id = %s AND archived_month = 'infinity';
+    """, (pool_name, round_id))
+    total_tickets, participants, digest = cur.fetchone()
+    if total_tickets == 0:
+        return [], secret
+
+    if secret is None:
+        # Rounds opened before commitments existed: the seed still covers every entry
+        logging.warning(f"{pool_name} round {round_id} has no published seed commitment; drawing with a fresh secret.")
+        secret = secrets.token_hex(32)
+    seed = make_seed(secret, pool_name, round_id, digest)
+
+    winners, winning_tickets = [], []
+    for ticket in ticket_stream(seed, total_tickets):
+        cur.execute("""
+            SELECT chat_id FROM pool_participants
+            WHERE pool_name = %s AND round_id = %s AND first_ticket <= %s AND archived_month = 'infinity'
+            ORDER BY first_ticket DESC
+            LIMIT 1;
+        """, (pool_name, round_id, ticket))
+        chat_id = cur.fetchone()[0]
+        if chat_id not in winners:
+            winners.append(chat_id)
+            winning_tickets.append(ticket)
+            if len(winners) == min(winner_count, participants):
+                break
+
+    cur.execute("""
+        UPDATE pool_rounds SET seed_secret = %s, draw_seed = %s, total_tickets = %s,
+                               winning_tickets = %s, winner_chat_ids = %s
+        WHERE pool_name = %s AND round_id = %s;
+    """, (secret, seed, total_tickets, winning_tickets, winners, pool_name, round_id))
+    logging.info(f"Drew {pool_name} round {round_id}: seed {seed}, tickets {winning_tickets} of {total_tickets}.")
+    return winners, secret
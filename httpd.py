@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+# Largest request body we accept (webhook payloads are small)
+MAX_BODY_SIZE = 1024 * 1024
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT = 30
+# Headers and body of a request must arrive within this many seconds of its request line
+REQUEST_TIMEOUT = 10
+# Most header lines accepted in one request
+MAX_HEADERS = 100
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+            405: 'Method Not Allowed', 413: 'Payload Too Large', 431: 'Request Header Fields Too Large',
+            500: 'Internal Server Error', 501: 'Not Implemented'}
+
+# A request that is answered with an error and then the connection closed
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+async def _read_chunked(reader):
+    body = b''
+    while True:
+        size = int((await reader.readline()).split(b';')[0].strip(), 16)
+        if len(body) + size > MAX_BODY_SIZE:
+            raise RequestError(413, 'payload too large')
+        if size == 0:
+            break
+        body += await reader.readexactly(size)
+        await reader.readexactly(2)
+    # Skip any trailer headers
+    for _ in range(MAX_HEADERS + 1):
+        if await reader.readline() in (b'\r\n', b'\n', b''):
+            return body
+    raise RequestError(431, 'too many trailer fields')
+
+async def _read_headers_and_body(reader):
+    headers = {}
+    for _ in range(MAX_HEADERS + 1):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise RequestError(431, 'too many header fields')
+
+    transfer_encoding = headers.get('transfer-encoding', '').lower()
+    if transfer_encoding == 'chunked':
+        return headers, await _read_chunked(reader)
+    if transfer_encoding:
+        raise RequestError(501, 'unsupported transfer encoding')
+    length = int(headers.get('content-length', 0) or 0)
+    if length > MAX_BODY_SIZE:
+        raise RequestError(413, 'payload too large')
+    return headers, await reader.readexactly(length) if length else b''
+
+# Read one request; returns None when the client closed the connection
+async def _read_request(reader):
+    request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+    parts = request_line.decode('latin-1').split()
+    if len(parts) < 3:
+        return None
+    method, path, version = parts[0], parts[1], parts[2]
+    # Slow clients may not hold a connection open by trickling in headers or body
+    headers, body = await asyncio.wait_for(_read_headers_and_body(reader), REQUEST_TIMEOUT)
+    return method, path, version, headers, body
+
+# Minimal HTTP/1.1 server for the bot's internal endpoints, with keep-alive.
+# handler(method, path, headers, body) must return (status, content_type, body_bytes).
+async def serve(host, port, handler):
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except RequestError as e:
+                    status, content_type, body = e.status, 'text/plain', str(e).encode()
+                    keep_alive = False
+                else:
+                    if request is None:
+                        return
+                    method, path, version, headers, request_body = request
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                    try:
+                        status, content_type, body = await handler(method, path, headers, request_body)
+                    except Exception as e:
+                        logging.error(f"Error while handling {method} {path}: {e}")
+                        status, content_type, body = 500, 'text/plain', b'internal error'
+
+                writer.write(
+                    f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(on_connection, host, port, backlog=1024)
+    logging.info(f"Listening for HTTP requests on {host}:{port}")
+    return server
@@ -0,0 +1,167 @@
+import os
+import asyncio
+import logging
+import functools
+import psycopg2
+import db
+import metrics
+
+# Multi-replica mode: pool lifecycle jobs only run on the replica holding the leader lock
+MULTI_REPLICA = os.getenv('MULTI_REPLICA', '0') == '1'
+# Arbitrary key for the session-level advisory lock that elects the leader
+LEADER_LOCK_ID = 7246002
+# How often followers try to take over and the leader checks it still holds the lock
+LEADER_CHECK_INTERVAL = float(os.getenv('LEADER_CHECK_INTERVAL', '5'))
+
+_conn = None
+# Without MULTI_REPLICA the single process is always the leader
+_is_leader = not MULTI_REPLICA
+_task = None
+# Coroutine functions run whenever this replica takes over (e.g. to resume interrupted work)
+_on_elected = []
+# Coroutine functions run whenever this replica loses the lead (e.g. to stop its scheduler)
+_on_demoted = []
+# Leader-only work in flight (jobs and catch-up tasks); cancelled when the lead is lost
+_leader_tasks = set()
+
+def is_leader():
+    return _is_leader
+
+def on_elected(callback):
+    _on_elected.append(callback)
+
+def on_demoted(callback):
+    _on_demoted.append(callback)
+
+# Run a coroutine as leader-only background work, cancelled if this replica loses the lead
+def create_task(coroutine):
+    task = asyncio.create_task(coroutine)
+    _leader_tasks.add(task)
+    task.add_done_callback(_leader_tasks.discard)
+    return task
+
+# Returns False if a callback failed, in which case this replica must not keep the lead
+async def _become_leader():
+    ok = True
+    for callback in _on_elected:
+        try:
+            await callback()
+        except Exception as e:
+            logging.error(f"Error in leader start-up callback {callback.__name__}: {e}")
+            ok = False
+    return ok
+
+# Stop everything that only the leader may do; the new leader resumes it
+async def _step_down():
+    for task in list(_leader_tasks):
+        task.cancel()
+    for callback in _on_demoted:
+        try:
+            await callback()
+        except Exception as e:
+            logging.error(f"Error in leader step-down callback {callback.__name__}: {e}")
+
+# One election round, run on an executor thread. The lock lives as long as the
+# dedicated connection does, so a crashed leader releases it automatically.
+def _tick():
+    global _conn, _is_leader
+    try:
+        if _conn is None or _conn.closed:
+            _conn = db.connect_dedicated()
+        with _conn.cursor() as cur:
+            if _is_leader:
+                # Make sure the session (and with it the lock) is still alive
+                cur.execute("SELECT 1;")
+            else:
+                cur.execute("SELECT pg_try_advisory_lock(%s);", (LEADER_LOCK_ID,))
+                if cur.fetchone()[0]:
+                    _is_leader = True
+                    logging.info("This replica is now the leader.")
+    except psycopg2.Error as e:
+        if _is_leader:
+            logging.error(f"Lost the leader lock: {e}")
+        _is_leader = False
+        if _conn is not None:
+            try:
+                _conn.close()
+            except psycopg2.Error:
+                pass
+        _conn = None
+
+# Give the lock back (run on an executor thread) so another replica, or this one on a later round, can take over
+def _resign():
+    global _conn, _is_leader
+    _is_leader = False
+    if _conn is None:
+        return
+    try:
+        with _conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (LEADER_LOCK_ID,))
+    except psycopg2.Error:
+        # Closing the session releases the lock as well
+        try:
+            _conn.close()
+        except psycopg2.Error:
+            pass
+        _conn = None
+
+async def _run():
+    loop = asyncio.get_running_loop()
+    while True:
+        was_leader = _is_leader
+        await loop.run_in_executor(None, _tick)
+        if _is_leader and not was_leader:
+            if not await _become_leader():
+                # A leader that could not start (e.g. its scheduler) would hold the lock doing nothing
+                logging.error("Taking over failed, releasing the leader lock.")
+                await loop.run_in_executor(None, _resign)
+                await _step_down()
+        elif was_leader and not _is_leader:
+            await _step_down()
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+
+# Without MULTI_REPLICA there is nobody to hand over to, so a failed take-over is retried
+async def _lead_alone():
+    while not await _become_leader():
+        await _step_down()
+        logging.error(f"Taking over failed, retrying in {LEADER_CHECK_INTERVAL:g}s.")
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+
+# Election and the leader callbacks run in the background so they never delay startup
+async def start():
+    global _task
+    if MULTI_REPLICA:
+        _task = asyncio.create_task(_run())
+    else:
+        _task = asyncio.create_task(_lead_alone())
+
+async def stop():
+    global _task, _conn, _is_leader
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    if _conn is not None:
+        # Closing the session releases the lock right away so a follower can take over
+        _conn.close()
+        _conn = None
+        _is_leader = False
+
+# Wrap a job so it is skipped on replicas that are not the leader, and cancelled if the lead is
+# lost while it runs
+def leader_only(job):
+    @functools.wraps(job)
+    async def wrapper(*args, **kwargs):
+        if not _is_leader:
+            logging.debug(f"Skipping {job.__name__}: not the leader.")
+            return
+        task = asyncio.current_task()
+        _leader_tasks.add(task)
+        try:
+            return await job(*args, **kwargs)
+        finally:
+            _leader_tasks.discard(task)
+    return wrapper
+
+metrics.register_collector(lambda: {
+    ('leader', None): int(_is_leader),
+})
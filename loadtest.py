@@ -0,0 +1,237 @@
+# Load-testing harness: drives the real handlers with synthetic updates, a fake Telegram bot,
+# a local CryptoBot stub and a local Postgres, and reports latency and resource usage.
+#
+# Usage:
+#   BENCH_DATABASE_URL=postgresql://localhost/lottery_bench python loadtest.py --users 1000 5000
+#
+# The benchmark database is wiped before every run, so never point it at production.
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import threading
+import logging
+import statistics
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL')
+if not BENCH_DATABASE_URL:
+    sys.exit("Set BENCH_DATABASE_URL to a scratch Postgres database (it will be wiped).")
+
+# Must be set before the bot modules read their configuration
+os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+os.environ.setdefault('DB_SSLMODE', 'disable')
+os.environ.setdefault('CRYPTBOT_API_TOKEN', 'bench-token')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:bench')
+
+from telegram import Update, Message, Chat
+import db
+import httpd
+import cryptobot
+import migrations
+import pool_registry
+import registration
+import Raffle_Final_Crypto as bot_app
+
+# Stand-in for telegram.Bot that records sends instead of calling Telegram
+class FakeBot:
+    def __init__(self, send_latency=0.0):
+        self.send_latency = send_latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent += 1
+
+# Local CryptoBot stub: every invoice is reported as paid on the first status poll
+class CryptoBotStub:
+    def __init__(self):
+        self.calls = {}
+        self.next_invoice_id = 1
+
+    async def handle(self, method, path, headers, body):
+        name = path.rsplit('/', 1)[-1]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        payload = json.loads(body or b'{}')
+
+        if name == 'createInvoice':
+            invoice_id = self.next_invoice_id
+            self.next_invoice_id += 1
+            result = {'invoice_id': invoice_id, 'bot_invoice_url': f'https://t.me/CryptoBot?start=bench{invoice_id}'}
+        elif name == 'getInvoices':
+            ids = [int(i) for i in payload.get('invoice_ids', '').split(',') if i]
+            result = {'items': [{'invoice_id': i, 'status': 'paid'} for i in ids]}
+        elif name == 'transfer':
+            result = {'transfer_id': 1, 'status': 'completed'}
+        else:
+            return 404, 'application/json', b'{"ok":false}'
+        return 200, 'application/json', json.dumps({'ok': True, 'result': result}).encode()
+
+# Run the stub on its own thread and event loop so it does not compete with the bot's loop
+def start_stub_server(stub, port):
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(httpd.serve('127.0.0.1', port, stub.handle))
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name='cryptobot-stub', daemon=True).start()
+    ready.wait()
+    return loop
+
+# Measures how late the event loop wakes up from a short sleep
+async def monitor_loop_lag(samples, interval=0.01):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+def make_update(update_id, chat_id, text):
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, text=text)
+    return Update(update_id=update_id, message=message)
+
+def make_context(bot):
+    return SimpleNamespace(bot=bot, args=[], job_queue=None)
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def timed(latencies, name, coro):
+    started = time.perf_counter()
+    await coro
+    latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+async def run_concurrently(concurrency, coros):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(coro):
+        async with semaphore:
+            await coro
+
+    await asyncio.gather(*[limited(coro) for coro in coros])
+
+def _reset_database(cur):
+    cur.execute("""
+        TRUNCATE users, invoices, pool_participants, transfers, payouts,
+                 broadcast_deliveries, broadcasts, pool_rounds RESTART IDENTITY;
+        UPDATE pools SET pool_amount = 0, participant_count = 0, ticket_count = 0, round_id = 1;
+    """)
+
+async def run_scenario(users, concurrency, stub):
+    await migrations.migrate()
+    await db.run_transaction(_reset_database)
+    registration.known_users.clear()
+    stub.calls.clear()
+
+    fake_bot = FakeBot()
+    latencies = {}
+    lag_samples = []
+    connections_before = db.get_stats()['connections_opened']
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+    started = time.perf_counter()
+
+    chat_ids = range(1, users + 1)
+    pool = pool_registry.POOLS[0]
+    update_id = iter(range(1, 10 * users + 1))
+
+    await run_concurrently(concurrency, [
+        timed(latencies, 'start_command', bot_app.start_command(make_update(next(update_id), chat_id, '/start'), make_context(fake_bot)))
+        for chat_id in chat_ids
+    ])
+    await run_concurrently(concurrency, [
+        timed(latencies, 'handle_join', bot_app.handle_join(make_update(next(update_id), chat_id, pool.button), make_context(fake_bot), pool.entry_fee, pool.name))
+        for chat_id in chat_ids
+    ])
+    await timed(latencies, 'check_payment_status', bot_app.check_payment_status(make_context(fake_bot)))
+    await run_concurrently(concurrency, [
+        timed(latencies, 'status', bot_app.status(make_update(next(update_id), chat_id, '📊 Status'), make_context(fake_bot)))
+        for chat_id in chat_ids
+    ])
+    await run_concurrently(concurrency, [
+        timed(latencies, 'players', bot_app.players(make_update(next(update_id), chat_id, '👥 Players'), make_context(fake_bot)))
+        for chat_id in chat_ids
+    ])
+    # Make sure every registration reached the database before broadcasting to all users
+    await registration.flush()
+    await timed(latencies, 'broadcast_message', bot_app.broadcast_message(SimpleNamespace(bot=fake_bot), "Benchmark broadcast"))
+
+    elapsed = time.perf_counter() - started
+    monitor.cancel()
+
+    return {
+        'users': users,
+        'elapsed': elapsed,
+        'handlers': {
+            name: {
+                'count': len(values),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+            }
+            for name, values in latencies.items()
+        },
+        'loop_lag_ms': {
+            'mean': statistics.fmean(lag_samples) * 1000 if lag_samples else 0.0,
+            'p99': percentile(lag_samples, 99) * 1000,
+            'max': max(lag_samples, default=0.0) * 1000,
+        },
+        'db_connections_opened': db.get_stats()['connections_opened'] - connections_before,
+        'db_acquire_avg_ms': db.get_stats()['acquire_time_avg'] * 1000,
+        'http_calls': dict(stub.calls),
+        'messages_sent': fake_bot.sent,
+    }
+
+def print_report(report):
+    print(f"\n=== {report['users']} users in {report['elapsed']:.1f}s ===")
+    print(f"{'handler':<22}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in report['handlers'].items():
+        print(f"{name:<22}{row['count']:>8}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+    lag = report['loop_lag_ms']
+    print(f"event-loop lag: mean {lag['mean']:.2f} ms, p99 {lag['p99']:.2f} ms, max {lag['max']:.2f} ms")
+    print(f"DB connections opened: {report['db_connections_opened']} (avg acquire {report['db_acquire_avg_ms']:.3f} ms)")
+    print(f"HTTP calls: {report['http_calls']}")
+    print(f"Telegram messages sent: {report['messages_sent']}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent users against the bot's handlers.")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000], help="Simulated user counts, one run each")
+    parser.add_argument('--concurrency', type=int, default=500, help="Updates in flight at once")
+    parser.add_argument('--stub-port', type=int, default=18080)
+    parser.add_argument('--json', action='store_true', help="Print the reports as JSON")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    stub = CryptoBotStub()
+    # The stub runs on a daemon thread and goes away with the process
+    start_stub_server(stub, args.stub_port)
+    cryptobot.CRYPTBOT_API_URL = f'http://127.0.0.1:{args.stub_port}/api/'
+
+    reports = []
+    try:
+        for users in args.users:
+            report = await run_scenario(users, args.concurrency, stub)
+            reports.append(report)
+            if not args.json:
+                print_report(report)
+    finally:
+        await cryptobot.close()
+        db.close_pool()
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+if __name__ == '__main__':
+    asyncio.run(main())
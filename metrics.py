@@ -0,0 +1,171 @@
+import os
+import time
+import asyncio
+import bisect
+import logging
+import threading
+import functools
+import httpd
+
+# Local Prometheus-style endpoint; disabled unless a port is configured
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+# Event-loop lag is sampled by sleeping for this long and measuring how late we wake up
+LOOP_LAG_INTERVAL = 0.1
+
+_lock = threading.Lock()
+# (name, labels) -> {'buckets': [...], 'count': n, 'sum': s}
+_histograms = {}
+# (name, labels) -> value
+_counters = {}
+_gauges = {}
+# Callables returning {(name, labels): value} gauges at scrape time
+_collectors = []
+
+_server = None
+_lag_task = None
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+# Record one observation in a histogram (safe to call from executor threads)
+def observe(name, value, labels=None):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0}
+        histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+def inc(name, labels=None, amount=1):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def set_gauge(name, value, labels=None):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+# Wrap a PTB handler callback so its latency and errors are recorded
+def instrument_handler(name, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            inc('handler_errors_total', {'handler': name})
+            raise
+        finally:
+            observe('handler_latency_seconds', time.perf_counter() - started, {'handler': name})
+    return wrapper
+
+# Wrap a scheduled job (APScheduler or PTB job queue) the same way
+def instrument_job(name, job):
+    @functools.wraps(job)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await job(*args, **kwargs)
+        except Exception:
+            inc('job_errors_total', {'job': name})
+            raise
+        finally:
+            observe('job_latency_seconds', time.perf_counter() - started, {'job': name})
+    return wrapper
+
+# Instrument every handler registered on the application
+def instrument_application(application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            commands = getattr(handler, 'commands', None)
+            name = '/' + sorted(commands)[0] if commands else getattr(handler.callback, '__name__', type(handler).__name__)
+            handler.callback = instrument_handler(name, handler.callback)
+
+async def _monitor_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        observe('event_loop_lag_seconds', lag)
+        set_gauge('event_loop_lag_last_seconds', lag)
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+# Render every metric in the Prometheus text exposition format
+def render():
+    gauges = {}
+    for collector in _collectors:
+        try:
+            for (name, labels), value in collector().items():
+                gauges[_key(name, labels)] = value
+        except Exception as e:
+            logging.error(f"Metrics collector failed: {e}")
+
+    with _lock:
+        histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in _histograms.items()}
+        counters = dict(_counters)
+        gauges.update(_gauges)
+
+    lines = []
+    seen = set()
+
+    def header(name, kind):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', _format_value(bound))])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']!r}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, 'counter')
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    for (name, labels), value in sorted(gauges.items()):
+        header(name, 'gauge')
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    return '\n'.join(lines) + '\n'
+
+async def _handle_request(method, path, headers, body):
+    if path.split('?')[0] != '/metrics':
+        return 404, 'text/plain', b'not found'
+    return 200, 'text/plain; version=0.0.4', render().encode()
+
+async def start():
+    global _server, _lag_task
+    _lag_task = asyncio.create_task(_monitor_loop_lag())
+    if METRICS_PORT:
+        _server = await httpd.serve(METRICS_HOST, METRICS_PORT, _handle_request)
+
+async def stop():
+    global _server, _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        _lag_task = None
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,262 @@
+import logging
+import db
+
+# Arbitrary key for the advisory lock that keeps replicas from migrating at the same time
+MIGRATION_LOCK_ID = 7246001
+
+# Migrations 9 and 10 need a serial id on pool_participants and transfers, which migration 0 only
+# creates on fresh databases. Add it where it is missing (numbering existing rows) and stop with a
+# clear error if the column is not backed by <table>_id_seq.
+def _serial_id(table):
+    return f"""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_schema = current_schema() AND table_name = '{table}' AND column_name = 'id') THEN
+                ALTER TABLE {table} ADD COLUMN id SERIAL;
+            END IF;
+            IF pg_get_serial_sequence('{table}', 'id') IS DISTINCT FROM current_schema() || '.{table}_id_seq'
+               OR EXISTS (SELECT 1 FROM information_schema.columns
+                          WHERE table_schema = current_schema() AND table_name = '{table}' AND column_name = 'id'
+                            AND is_identity = 'YES') THEN
+                RAISE EXCEPTION '{table}.id must be a serial column backed by the sequence {table}_id_seq';
+            END IF;
+        END
+        $$;
+    """
+
+# Ordered list of (version, description, SQL). Never edit an applied migration; append a new one.
+MIGRATIONS = [
+    (0, "base tables (no-op on existing deployments)", """
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id BIGINT PRIMARY KEY,
+            wallet_address TEXT
+        );
+        CREATE TABLE IF NOT EXISTS pools (
+            pool_name TEXT PRIMARY KEY,
+            pool_amount NUMERIC NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS invoices (
+            invoice_id BIGINT PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            amount NUMERIC NOT NULL,
+            status TEXT NOT NULL,
+            pool_name TEXT NOT NULL,
+            creation_time TIMESTAMPTZ NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pool_participants (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            pool_name TEXT NOT NULL,
+            invoice_id BIGINT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS transfers (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            amount NUMERIC NOT NULL,
+            asset TEXT NOT NULL,
+            status TEXT NOT NULL,
+            timestamp TIMESTAMPTZ NOT NULL
+        );
+    """),
+    (1, "broadcast progress tables", """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id SERIAL PRIMARY KEY,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_chat_id BIGINT,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts (broadcast_id),
+            chat_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            PRIMARY KEY (broadcast_id, chat_id)
+        );
+    """),
+    (2, "pool rounds and participant counters", """
+        ALTER TABLE pools ADD COLUMN IF NOT EXISTS round_id INTEGER NOT NULL DEFAULT 1;
+        ALTER TABLE pools ADD COLUMN IF NOT EXISTS participant_count INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE pool_participants ADD COLUMN IF NOT EXISTS round_id INTEGER NOT NULL DEFAULT 1;
+
+        INSERT INTO pools (pool_name, pool_amount)
+        SELECT name, 0 FROM (VALUES ('Bronze Pool'), ('Silver Pool'), ('Gold Pool')) AS defaults (name)
+        WHERE NOT EXISTS (SELECT 1 FROM pools WHERE pools.pool_name = defaults.name);
+
+        -- Existing participants are treated as members of the current round
+        UPDATE pools SET participant_count = counts.n
+        FROM (SELECT pool_name, COUNT(*) AS n FROM pool_participants GROUP BY pool_name) AS counts
+        WHERE pools.pool_name = counts.pool_name;
+    """),
+    (3, "indexes for hot-path lookups", """
+        CREATE INDEX IF NOT EXISTS pool_participants_pool_round_idx ON pool_participants (pool_name, round_id);
+        CREATE INDEX IF NOT EXISTS pool_participants_chat_pool_idx ON pool_participants (chat_id, pool_name, round_id);
+        CREATE INDEX IF NOT EXISTS invoices_pending_idx ON invoices (creation_time) WHERE status = 'pending';
+    """),
+    (4, "stream round participants in chat_id order", """
+        CREATE INDEX IF NOT EXISTS pool_participants_round_chat_idx ON pool_participants (pool_name, round_id, chat_id);
+        DROP INDEX IF EXISTS pool_participants_pool_round_idx;
+    """),
+    (5, "durable payout queue", """
+        CREATE TABLE IF NOT EXISTS payouts (
+            payout_id SERIAL PRIMARY KEY,
+            pool_name TEXT NOT NULL,
+            round_id INTEGER NOT NULL,
+            chat_id BIGINT NOT NULL,
+            amount NUMERIC NOT NULL,
+            asset TEXT NOT NULL,
+            spend_id TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            locked_until TIMESTAMPTZ,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            UNIQUE (pool_name, round_id)
+        );
+        CREATE INDEX IF NOT EXISTS payouts_due_idx ON payouts (next_attempt_at) WHERE status IN ('pending', 'processing');
+    """),
+    (6, "pool round timing state", """
+        CREATE TABLE IF NOT EXISTS pool_rounds (
+            pool_name TEXT NOT NULL,
+            round_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'scheduled',
+            opens_at TIMESTAMPTZ,
+            closes_at TIMESTAMPTZ,
+            PRIMARY KEY (pool_name, round_id)
+        );
+        INSERT INTO pool_rounds (pool_name, round_id)
+        SELECT pool_name, round_id FROM pools
+        ON CONFLICT DO NOTHING;
+    """),
+    (7, "reuse pending invoices", """
+        ALTER TABLE invoices ADD COLUMN IF NOT EXISTS invoice_url TEXT;
+        CREATE INDEX IF NOT EXISTS invoices_pending_chat_idx ON invoices (chat_id, pool_name) WHERE status = 'pending';
+    """),
+    (8, "backfill pool totals of the current rounds", """
+        UPDATE pools SET pool_amount = totals.total
+        FROM (
+            SELECT pp.pool_name, SUM(i.amount) AS total
+            FROM pool_participants pp
+            JOIN pools p ON p.pool_name = pp.pool_name AND p.round_id = pp.round_id
+            JOIN invoices i ON i.invoice_id = pp.invoice_id
+            GROUP BY pp.pool_name
+        ) AS totals
+        WHERE pools.pool_name = totals.pool_name;
+    """),
+    (9, "verifiable weighted draws with several winners", _serial_id('pool_participants') + """
+        -- One ticket per cent paid; each entry holds the ticket range [first_ticket, first_ticket + tickets)
+        ALTER TABLE pool_participants ADD COLUMN IF NOT EXISTS tickets BIGINT NOT NULL DEFAULT 1;
+        ALTER TABLE pool_participants ADD COLUMN IF NOT EXISTS first_ticket BIGINT;
+        ALTER TABLE pools ADD COLUMN IF NOT EXISTS ticket_count BIGINT NOT NULL DEFAULT 0;
+
+        UPDATE pool_participants pp SET tickets = GREATEST(1, ROUND(i.amount * 100))
+        FROM invoices i WHERE i.invoice_id = pp.invoice_id;
+        UPDATE pool_participants pp SET first_ticket = numbered.first_ticket
+        FROM (
+            SELECT id, SUM(tickets) OVER (PARTITION BY pool_name, round_id ORDER BY invoice_id, id) - tickets AS first_ticket
+            FROM pool_participants
+        ) AS numbered
+        WHERE pp.id = numbered.id;
+        UPDATE pools SET ticket_count = totals.tickets
+        FROM (
+            SELECT pp.pool_name, SUM(pp.tickets) AS tickets
+            FROM pool_participants pp
+            JOIN pools p ON p.pool_name = pp.pool_name AND p.round_id = pp.round_id
+            GROUP BY pp.pool_name
+        ) AS totals
+        WHERE pools.pool_name = totals.pool_name;
+        CREATE INDEX IF NOT EXISTS pool_participants_round_ticket_idx ON pool_participants (pool_name, round_id, first_ticket);
+
+        ALTER TABLE pool_rounds ADD COLUMN IF NOT EXISTS seed_commitment TEXT;
+        ALTER TABLE pool_rounds ADD COLUMN IF NOT EXISTS seed_secret TEXT;
+        ALTER TABLE pool_rounds ADD COLUMN IF NOT EXISTS draw_seed TEXT;
+        ALTER TABLE pool_rounds ADD COLUMN IF NOT EXISTS total_tickets BIGINT;
+        ALTER TABLE pool_rounds ADD COLUMN IF NOT EXISTS winning_tickets BIGINT[];
+        ALTER TABLE pool_rounds ADD COLUMN IF NOT EXISTS winner_chat_ids BIGINT[];
+
+        -- A round can now have several winners
+        ALTER TABLE payouts DROP CONSTRAINT IF EXISTS payouts_pool_name_round_id_key;
+        ALTER TABLE payouts ADD CONSTRAINT payouts_round_winner_key UNIQUE (pool_name, round_id, chat_id);
+    """),
+    (10, "partition participants, invoices and transfers into active and monthly archive partitions",
+     _serial_id('pool_participants') + _serial_id('transfers') + """
+        -- Every table is rebuilt as a parent partitioned on archived_month; existing rows start in the
+        -- active partition and the archival job moves finished ones out
+        ALTER TABLE pool_participants RENAME TO pool_participants_unpartitioned;
+        ALTER SEQUENCE pool_participants_id_seq OWNED BY NONE;
+        CREATE TABLE pool_participants (
+            LIKE pool_participants_unpartitioned INCLUDING DEFAULTS,
+            archived_month DATE NOT NULL DEFAULT 'infinity',
+            PRIMARY KEY (id, archived_month)
+        ) PARTITION BY RANGE (archived_month);
+        ALTER SEQUENCE pool_participants_id_seq OWNED BY pool_participants.id;
+        CREATE TABLE pool_participants_active PARTITION OF pool_participants FOR VALUES FROM ('infinity') TO (MAXVALUE);
+        INSERT INTO pool_participants SELECT *, 'infinity' FROM pool_participants_unpartitioned;
+        DROP TABLE pool_participants_unpartitioned;
+        CREATE INDEX pool_participants_chat_pool_idx ON pool_participants (chat_id, pool_name, round_id);
+        CREATE INDEX pool_participants_round_chat_idx ON pool_participants (pool_name, round_id, chat_id);
+        CREATE INDEX pool_participants_round_ticket_idx ON pool_participants (pool_name, round_id, first_ticket);
+
+        ALTER TABLE invoices RENAME TO invoices_unpartitioned;
+        CREATE TABLE invoices (
+            LIKE invoices_unpartitioned INCLUDING DEFAULTS,
+            archived_month DATE NOT NULL DEFAULT 'infinity',
+            PRIMARY KEY (invoice_id, archived_month)
+        ) PARTITION BY RANGE (archived_month);
+        CREATE TABLE invoices_active PARTITION OF invoices FOR VALUES FROM ('infinity') TO (MAXVALUE);
+        INSERT INTO invoices SELECT *, 'infinity' FROM invoices_unpartitioned;
+        DROP TABLE invoices_unpartitioned;
+        CREATE INDEX invoices_pending_idx ON invoices (creation_time) WHERE status = 'pending';
+        CREATE INDEX invoices_pending_chat_idx ON invoices (chat_id, pool_name) WHERE status = 'pending';
+
+        ALTER TABLE transfers RENAME TO transfers_unpartitioned;
+        ALTER SEQUENCE transfers_id_seq OWNED BY NONE;
+        CREATE TABLE transfers (
+            LIKE transfers_unpartitioned INCLUDING DEFAULTS,
+            archived_month DATE NOT NULL DEFAULT 'infinity',
+            PRIMARY KEY (id, archived_month)
+        ) PARTITION BY RANGE (archived_month);
+        ALTER SEQUENCE transfers_id_seq OWNED BY transfers.id;
+        CREATE TABLE transfers_active PARTITION OF transfers FOR VALUES FROM ('infinity') TO (MAXVALUE);
+        INSERT INTO transfers SELECT *, 'infinity' FROM transfers_unpartitioned;
+        DROP TABLE transfers_unpartitioned;
+    """),
+    (11, "keep each closed round's pot until its payouts are queued", """
+        ALTER TABLE pool_rounds ADD COLUMN IF NOT EXISTS pot NUMERIC;
+        ALTER TABLE pool_rounds ADD COLUMN IF NOT EXISTS settled_at TIMESTAMPTZ;
+        -- Rounds closed before this have no stored pot; they count as settled
+        UPDATE pool_rounds SET settled_at = COALESCE(closes_at, now()) WHERE state = 'closed';
+        CREATE INDEX IF NOT EXISTS pool_rounds_unsettled_idx ON pool_rounds (closes_at)
+        WHERE state = 'closed' AND settled_at IS NULL;
+    """),
+]
+
+def _migrate(cur):
+    # Pooled connections carry a short statement_timeout; rebuilding large tables takes longer
+    cur.execute("SET LOCAL statement_timeout = 0;")
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    cur.execute("SELECT version FROM schema_migrations;")
+    applied = {row[0] for row in cur.fetchall()}
+
+    for version, description, sql in MIGRATIONS:
+        if version in applied:
+            continue
+        logging.info(f"Applying migration {version}: {description}")
+        cur.execute(sql)
+        cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s);", (version, description))
+
+# Bring the database schema up to date (all pending migrations run in one transaction)
+async def migrate():
+    await db.run_transaction(_migrate)
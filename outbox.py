@@ -0,0 +1,157 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import deque
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import metrics
+import ratelimit
+
+# Priority classes, highest first. Calls choose one with rate_limit_args={'priority': ...};
+# anything sent without it is a reply to the user's own action.
+INTERACTIVE = 0
+TRANSACTIONAL = 1  # payment and payout notices
+BULK = 2  # broadcasts and round reset notices
+CLASS_NAMES = {INTERACTIVE: 'interactive', TRANSACTIONAL: 'transactional', BULK: 'bulk'}
+
+# Messages per second across all chats (Telegram allows roughly 30)
+OUTBOX_RATE = float(os.getenv('OUTBOX_RATE', os.getenv('BROADCAST_RATE', '25')))
+# Messages per second to one chat, and the burst allowed on top (Telegram allows about one per second)
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', '3'))
+# A message is re-sent this many times after Telegram answers with retry_after
+OUTBOX_MAX_RETRIES = 3
+# Budgets of the least recently messaged chats are dropped beyond this many
+MAX_TRACKED_CHATS = 100000
+# Telegram does not say whether a retry_after answer is about one chat or the whole bot. Answers for
+# this many different chats within OUTBOX_FLOOD_WINDOW seconds are taken as the bot-wide limit.
+OUTBOX_GLOBAL_FLOOD_CHATS = 3
+OUTBOX_FLOOD_WINDOW = 1.0
+
+# Central scheduler for every Bot API call aimed at a chat (plugged into PTB as the bot's rate limiter).
+# Each call waits for admission; one dispatcher admits waiting calls highest class first (in arrival
+# order within a class) at the global rate, setting aside calls to chats that are out of budget so
+# they do not hold up other chats. A retry_after answer defers that chat (or, when several chats get
+# one at once, all sends) and re-queues the call.
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self, rate=OUTBOX_RATE, chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST):
+        self.limiter = ratelimit.TokenBucket(rate)
+        # Per-chat budgets
+        self._chats = ratelimit.KeyedTokenBuckets(chat_rate, chat_burst, MAX_TRACKED_CHATS)
+        # (priority, seq, chat_id, future, enqueued at)
+        self._ready = []
+        # (ready at, priority, seq, chat_id, future, enqueued at) for chats that are out of budget
+        self._deferred = []
+        # (time, chat_id) of recent retry_after answers
+        self._floods = deque()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._depth = dict.fromkeys(CLASS_NAMES, 0)
+        self._stats = {(name, counter): 0 for name in CLASS_NAMES.values() for counter in ('sent', 'failed', 'retried')}
+
+    async def initialize(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    # Whether retry_after answers for several chats arrived at once, i.e. the bot-wide limit was hit
+    def _is_global_flood(self, chat_id, now):
+        self._floods.append((now, chat_id))
+        while now - self._floods[0][0] > OUTBOX_FLOOD_WINDOW:
+            self._floods.popleft()
+        return len({flooded for _, flooded in self._floods}) >= OUTBOX_GLOBAL_FLOOD_CHATS
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._deferred and self._deferred[0][0] <= now:
+                heapq.heappush(self._ready, heapq.heappop(self._deferred)[1:])
+            if not self._ready:
+                self._wakeup.clear()
+                timeout = self._deferred[0][0] - now if self._deferred else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self._ready)
+            priority, seq, chat_id, future, enqueued = entry
+            if future.done():
+                # The caller gave up (cancelled)
+                continue
+            wait = self._chats.wait_time(chat_id, now)
+            if wait > 0:
+                heapq.heappush(self._deferred, (now + wait, *entry))
+                continue
+
+            # Global budget, including any retry_after pause
+            await self.limiter.acquire()
+            self._chats.try_take(chat_id)
+            if not future.done():
+                future.set_result(None)
+
+    # Wait until the dispatcher lets this call through
+    async def _admit(self, priority, seq, chat_id):
+        if self._task is None:
+            await self.initialize()
+        future = asyncio.get_running_loop().create_future()
+        enqueued = time.perf_counter()
+        heapq.heappush(self._ready, (priority, seq, chat_id, future, enqueued))
+        self._depth[priority] += 1
+        self._wakeup.set()
+        try:
+            await future
+        finally:
+            self._depth[priority] -= 1
+            metrics.observe('outbox_wait_seconds', time.perf_counter() - enqueued, {'class': CLASS_NAMES[priority]})
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # Not a message to a chat (getMe, setWebhook, ...)
+            return await callback(*args, **kwargs)
+
+        priority = (rate_limit_args or {}).get('priority', INTERACTIVE)
+        name = CLASS_NAMES[priority]
+        # A retried call keeps its place in its class
+        seq = next(self._seq)
+        for attempt in range(OUTBOX_MAX_RETRIES + 1):
+            await self._admit(priority, seq, chat_id)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = float(e.retry_after)
+                if self._is_global_flood(chat_id, time.monotonic()):
+                    logging.warning(f"Flood limit hit for several chats, pausing all sends for {retry_after}s")
+                    self.limiter.pause(retry_after)
+                else:
+                    logging.warning(f"Flood limit hit sending {endpoint} to {chat_id}, deferring that chat for {retry_after}s")
+                    self._chats.pause(chat_id, retry_after)
+                if attempt == OUTBOX_MAX_RETRIES:
+                    self._stats[(name, 'failed')] += 1
+                    raise
+                self._stats[(name, 'retried')] += 1
+                continue
+            except Exception:
+                self._stats[(name, 'failed')] += 1
+                raise
+            self._stats[(name, 'sent')] += 1
+            return result
+
+    def get_stats(self):
+        stats = {f'{name}_{counter}': value for (name, counter), value in self._stats.items()}
+        stats.update({f'{CLASS_NAMES[priority]}_queued': depth for priority, depth in self._depth.items()})
+        return stats
+
+scheduler = OutboundScheduler()
+
+metrics.register_collector(lambda: {(f'outbox_{name}', None): value for name, value in scheduler.get_stats().items()})
@@ -0,0 +1,226 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timezone
+import db
+import cryptobot
+import pool_cache
+import user_cache
+import outbox
+
+# How often the reconciliation worker polls CryptoBot for pending invoices
+PAYMENT_POLL_INTERVAL = int(os.getenv('PAYMENT_POLL_INTERVAL', '60'))
+# Invoices not paid within this many seconds are expired (CryptoBot is told the same via expires_in)
+INVOICE_TIMEOUT = 900
+# Pending invoices CryptoBot still reports as active are only expired locally this much later, so a
+# payment made just before CryptoBot's own expiry is not lost to clock skew
+INVOICE_EXPIRY_GRACE = 60
+# Namespace of the advisory locks that serialize invoice creation per (chat, pool)
+INVOICE_LOCK_ID = 7246003
+# Max invoice IDs per getInvoices call (CryptoBot allows up to 1000)
+GET_INVOICES_BATCH_SIZE = int(os.getenv('GET_INVOICES_BATCH_SIZE', '100'))
+# Single confirmations (webhook events) arriving within this window are applied in one transaction
+PAYMENT_CONFIRM_BATCH_MS = float(os.getenv('PAYMENT_CONFIRM_BATCH_MS', '50'))
+
+# invoice_id -> future resolved with that invoice's confirmed rows
+_confirm_queue = {}
+_confirm_task = None
+
+# Mark a batch of invoices as paid, add their owners to the current round of each pool and
+# bump the pools' participant counters and totals (runs inside one transaction).
+# Each pool row gets one atomic increment per batch, however many invoices the batch holds.
+# Only pending invoices, and expired ones that were paid anyway (the payment raced the expiry), are
+# touched, so applying the same invoice twice is a no-op. Neither is archived yet (archival waits
+# ARCHIVE_AFTER_DAYS), so only the active invoices partition is scanned.
+# Every entry gets one draw ticket per cent paid, numbered on from the pool's ticket counter
+# (in invoice_id order within a batch), which keeps each round's ticket ranges contiguous.
+def apply_paid_invoices(cur, invoice_ids):
+    cur.execute("""
+        SELECT invoice_id, chat_id, pool_name FROM invoices
+        WHERE invoice_id = ANY(%s) AND status = 'expired' AND archived_month = 'infinity';
+    """, (list(invoice_ids),))
+    for invoice_id, chat_id, pool_name in cur.fetchall():
+        logging.warning(f"Invoice {invoice_id} of user {chat_id} was paid after it expired, entering the user into the {pool_name} anyway.")
+    # Lock the pools first so concurrent batches (and close_round) number tickets one after another
+    cur.execute("""
+        SELECT pool_name FROM pools
+        WHERE pool_name IN (SELECT pool_name FROM invoices WHERE invoice_id = ANY(%s) AND status IN ('pending', 'expired') AND archived_month = 'infinity')
+        ORDER BY pool_name
+        FOR UPDATE;
+    """, (list(invoice_ids),))
+    cur.execute("""
+        WITH paid AS (
+            UPDATE invoices SET status = 'paid'
+            WHERE invoice_id = ANY(%s) AND status IN ('pending', 'expired') AND archived_month = 'infinity'
+            RETURNING chat_id, pool_name, invoice_id, amount, GREATEST(1, ROUND(amount * 100))::bigint AS tickets
+        ),
+        inserted AS (
+            INSERT INTO pool_participants (chat_id, pool_name, invoice_id, round_id, tickets, first_ticket)
+            SELECT paid.chat_id, paid.pool_name, paid.invoice_id, COALESCE(pools.round_id, 1), paid.tickets,
+                   COALESCE(pools.ticket_count, 0) - paid.tickets
+                   + SUM(paid.tickets) OVER (PARTITION BY paid.pool_name ORDER BY paid.invoice_id)
+            FROM paid LEFT JOIN pools ON pools.pool_name = paid.pool_name
+            RETURNING chat_id, pool_name, invoice_id
+        ),
+        counted AS (
+            UPDATE pools SET participant_count = pools.participant_count + joined.n,
+                             pool_amount = pools.pool_amount + joined.total,
+                             ticket_count = pools.ticket_count + joined.tickets
+            FROM (SELECT pool_name, COUNT(*) AS n, SUM(amount) AS total, SUM(tickets) AS tickets
+                  FROM paid GROUP BY pool_name) AS joined
+            WHERE pools.pool_name = joined.pool_name
+        )
+        SELECT chat_id, pool_name, invoice_id, amount FROM paid;
+    """, (list(invoice_ids),))
+    rows = cur.fetchall()
+    # Every process drops the payers' cached memberships once this commits
+    user_cache.notify_users(cur, [row[0] for row in rows])
+    return rows
+
+# Link and id of the user's unexpired pending invoice for a pool, or None (active invoices partition only)
+def find_pending_invoice(cur, chat_id, pool_name):
+    cur.execute("""
+        SELECT invoice_url, invoice_id FROM invoices
+        WHERE chat_id = %s AND pool_name = %s AND status = 'pending' AND invoice_url IS NOT NULL
+          AND archived_month = 'infinity'
+          AND creation_time > now() - %s * interval '1 second'
+        ORDER BY creation_time DESC LIMIT 1;
+    """, (chat_id, pool_name, INVOICE_TIMEOUT))
+    return cur.fetchone()
+
+# Store a newly created invoice unless the user got another pending invoice for the pool in the
+# meantime (e.g. from a join handled by another replica); returns that invoice's link and id then,
+# else None. The per-(chat, pool) lock makes the check and the insert atomic across replicas.
+def store_invoice(cur, invoice_id, chat_id, amount, pool_name, invoice_url):
+    cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (INVOICE_LOCK_ID, f"{chat_id}:{pool_name}"))
+    existing = find_pending_invoice(cur, chat_id, pool_name)
+    if existing is not None:
+        return existing
+    cur.execute("""
+        INSERT INTO invoices (invoice_id, chat_id, amount, status, pool_name, creation_time, invoice_url)
+        VALUES (%s, %s, %s, 'pending', %s, now(), %s);
+    """, (invoice_id, chat_id, amount, pool_name, invoice_url))
+    return None
+
+# Mark a batch of invoices as expired (runs inside one transaction)
+def apply_expired_invoices(cur, invoice_ids):
+    cur.execute("""
+        UPDATE invoices SET status = 'expired'
+        WHERE invoice_id = ANY(%s) AND status = 'pending' AND archived_month = 'infinity'
+        RETURNING chat_id, pool_name, invoice_id;
+    """, (list(invoice_ids),))
+    return cur.fetchall()
+
+# Confirm paid invoices in one transaction and keep the pool cache in step
+async def confirm_paid_invoices(invoice_ids):
+    rows = await db.run_transaction(apply_paid_invoices, invoice_ids)
+    # Already credited (a redelivered event) or never stored, in which case the payer has to be found by hand
+    unmatched = {str(invoice_id) for invoice_id in invoice_ids} - {str(row[2]) for row in rows}
+    if unmatched:
+        logging.warning(f"Paid invoices without an open invoice row (already credited or unknown): {', '.join(sorted(unmatched))}")
+    user_cache.invalidate_users([row[0] for row in rows])
+    for chat_id, pool_name, invoice_id, amount in rows:
+        pool_cache.record_participants(pool_name, amount=amount)
+    return rows
+
+async def _confirm_queued():
+    while _confirm_queue:
+        await asyncio.sleep(PAYMENT_CONFIRM_BATCH_MS / 1000)
+        batch = dict(_confirm_queue)
+        _confirm_queue.clear()
+        try:
+            rows = await confirm_paid_invoices(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            continue
+        rows_by_invoice = {}
+        for row in rows:
+            rows_by_invoice.setdefault(str(row[2]), []).append(row)
+        for invoice_id, future in batch.items():
+            future.set_result(rows_by_invoice.get(str(invoice_id), []))
+
+# Confirm one paid invoice through the shared batch: many confirmations per second cost one
+# commit per PAYMENT_CONFIRM_BATCH_MS instead of one each. Returns the invoice's confirmed rows.
+async def confirm_paid_invoice(invoice_id):
+    global _confirm_task
+    future = _confirm_queue.get(invoice_id)
+    if future is None:
+        future = _confirm_queue[invoice_id] = asyncio.get_running_loop().create_future()
+    if _confirm_task is None or _confirm_task.done():
+        _confirm_task = asyncio.create_task(_confirm_queued())
+    return await future
+
+# Fetch the CryptoBot status of every given invoice, one getInvoices call per batch
+async def fetch_invoice_statuses(invoice_ids):
+    statuses = {}
+    for start in range(0, len(invoice_ids), GET_INVOICES_BATCH_SIZE):
+        batch = invoice_ids[start:start + GET_INVOICES_BATCH_SIZE]
+        try:
+            response = await cryptobot.call('getInvoices', {
+                'invoice_ids': ','.join(str(invoice_id) for invoice_id in batch),
+                'count': len(batch),
+            })
+        except cryptobot.CryptoBotError as e:
+            logging.error(f"Failed to fetch statuses for {len(batch)} invoices: {e}")
+            continue
+
+        if not response.get('ok'):
+            logging.error(f"Error while fetching invoice statuses: {response}")
+            continue
+
+        result = response['result']
+        items = result.get('items', []) if isinstance(result, dict) else result
+        for item in items:
+            statuses[str(item['invoice_id'])] = item['status']
+    return statuses
+
+async def notify_paid(bot, rows):
+    for chat_id, pool_name, invoice_id, amount in rows:
+        await bot.send_message(chat_id=chat_id, text=f"You have successfully joined the {pool_name}!",
+                               rate_limit_args={'priority': outbox.TRANSACTIONAL})
+
+async def notify_expired(bot, rows):
+    for chat_id, pool_name, invoice_id in rows:
+        await bot.send_message(chat_id=chat_id, text="Your payment verification has timed out. Please try again.",
+                               rate_limit_args={'priority': outbox.TRANSACTIONAL})
+
+# Poll every pending invoice in batches and resolve paid/expired ones in bulk
+async def reconcile_pending_invoices(bot):
+    pending = await db.fetchall("SELECT invoice_id, creation_time FROM invoices WHERE status = 'pending' AND archived_month = 'infinity';")
+    if not pending:
+        return
+
+    statuses = await fetch_invoice_statuses([invoice_id for invoice_id, _ in pending])
+
+    now = datetime.now(timezone.utc)
+    paid_ids = []
+    expired_ids = []
+    for invoice_id, creation_time in pending:
+        status = statuses.get(str(invoice_id))
+        if creation_time.tzinfo is None:
+            creation_time = creation_time.replace(tzinfo=timezone.utc)
+
+        if status == 'paid':
+            paid_ids.append(invoice_id)
+        # Invoices whose status could not be fetched are left for the next pass
+        elif status == 'expired' or (status is not None and (now - creation_time).total_seconds() > INVOICE_TIMEOUT + INVOICE_EXPIRY_GRACE):
+            expired_ids.append(invoice_id)
+
+    logging.info(f"Reconciled {len(pending)} pending invoices: {len(paid_ids)} paid, {len(expired_ids)} expired.")
+
+    if paid_ids:
+        try:
+            paid_rows = await confirm_paid_invoices(paid_ids)
+        except Exception as e:
+            logging.error(f"Database error while confirming payments: {e}")
+        else:
+            await notify_paid(bot, paid_rows)
+
+    if expired_ids:
+        try:
+            expired_rows = await db.run_transaction(apply_expired_invoices, expired_ids)
+        except Exception as e:
+            logging.error(f"Database error while updating invoice status: {e}")
+        else:
+            await notify_expired(bot, expired_rows)
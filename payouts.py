@@ -0,0 +1,170 @@
+import os
+import random
+import hashlib
+import logging
+import db
+import draw
+import cryptobot
+import outbox
+import user_cache
+
+# How often the payout worker looks for due jobs
+PAYOUT_POLL_INTERVAL = int(os.getenv('PAYOUT_POLL_INTERVAL', '15'))
+# A claimed job whose worker died becomes claimable again after this many seconds
+PAYOUT_LEASE_SECONDS = 120
+PAYOUT_MAX_ATTEMPTS = 10
+PAYOUT_MAX_BACKOFF = 3600
+
+# Same (pool, round, winner) always yields the same spend_id, so CryptoBot rejects a second transfer
+def make_spend_id(pool_name, round_id, chat_id):
+    digest = hashlib.sha256(f"{pool_name}:{round_id}:{chat_id}".encode()).hexdigest()
+    return f"payout-{digest[:40]}"
+
+def _enqueue(cur, pool_name, round_id, chat_id, amount, asset):
+    cur.execute("""
+        INSERT INTO payouts (pool_name, round_id, chat_id, amount, asset, spend_id)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (pool_name, round_id, chat_id) DO NOTHING;
+    """, (pool_name, round_id, chat_id, amount, asset, make_spend_id(pool_name, round_id, chat_id)))
+
+# Draw a closed round's winners and queue their prizes in one transaction, so the pot stored on the
+# round when it closed is never lost between the two. The prize is split equally, rounded down to
+# the cent. Settling a round again returns the stored draw and queues nothing new.
+# Returns the winners' chat_ids (in draw order) and the revealed secret.
+def settle_round(cur, pool_name, round_id, winner_count, cut_percentage, asset='USDT'):
+    winners, secret = draw.draw_round(cur, pool_name, round_id, winner_count)
+    if winners:
+        cur.execute("SELECT COALESCE(pot, 0) FROM pool_rounds WHERE pool_name = %s AND round_id = %s;", (pool_name, round_id))
+        prize_amount = float(cur.fetchone()[0]) * (1 - cut_percentage / 100)
+        share = int(prize_amount / len(winners) * 100) / 100
+        for chat_id in winners:
+            _enqueue(cur, pool_name, round_id, chat_id, share, asset)
+    cur.execute("""
+        UPDATE pool_rounds SET settled_at = now()
+        WHERE pool_name = %s AND round_id = %s AND settled_at IS NULL;
+    """, (pool_name, round_id))
+    return winners, secret
+
+async def settle(pool, round_id):
+    return await db.run_transaction(settle_round, pool.name, round_id, pool.winners, pool.cut_percentage)
+
+# Closed rounds that were never settled (the process stopped between closing and settling them)
+async def unsettled_rounds():
+    return await db.fetchall("""
+        SELECT pool_name, round_id FROM pool_rounds
+        WHERE state = 'closed' AND settled_at IS NULL
+        ORDER BY closes_at;
+    """)
+
+# Claim one due job. SKIP LOCKED lets several replicas claim different jobs concurrently,
+# and the lease makes jobs from a crashed worker claimable again.
+def _claim(cur):
+    cur.execute("""
+        UPDATE payouts SET status = 'processing', attempts = attempts + 1,
+                           locked_until = now() + %s * interval '1 second', updated_at = now()
+        WHERE payout_id = (
+            SELECT payout_id FROM payouts
+            WHERE (status = 'pending' AND next_attempt_at <= now())
+               OR (status = 'processing' AND locked_until < now())
+            ORDER BY payout_id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING payout_id, pool_name, chat_id, amount, asset, spend_id, attempts;
+    """, (PAYOUT_LEASE_SECONDS,))
+    return cur.fetchone()
+
+def _mark_paid(cur, payout_id, chat_id, amount, asset):
+    cur.execute("UPDATE payouts SET status = 'paid', last_error = NULL, updated_at = now() WHERE payout_id = %s;", (payout_id,))
+    cur.execute("""
+        INSERT INTO transfers (chat_id, amount, asset, status, timestamp)
+        VALUES (%s, %s, %s, %s, now());
+    """, (chat_id, amount, asset, 'successful'))
+
+def _mark_retry(cur, payout_id, attempts, error_message):
+    if attempts >= PAYOUT_MAX_ATTEMPTS:
+        cur.execute("UPDATE payouts SET status = 'failed', last_error = %s, updated_at = now() WHERE payout_id = %s;",
+                    (error_message, payout_id))
+        return
+    # Exponential backoff with jitter
+    delay = min(PAYOUT_MAX_BACKOFF, 30 * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+    cur.execute("""
+        UPDATE payouts SET status = 'pending', last_error = %s, updated_at = now(),
+                           next_attempt_at = now() + %s * interval '1 second'
+        WHERE payout_id = %s;
+    """, (error_message, delay, payout_id))
+
+# Make the user's unpaid prizes due again with a fresh attempt budget (runs in the transaction that
+# changes their wallet): a winner without a wallet fails every attempt until they set one.
+# Returns the number of payouts requeued.
+def requeue_user(cur, chat_id):
+    cur.execute("""
+        UPDATE payouts SET status = 'pending', attempts = 0, next_attempt_at = now(), updated_at = now()
+        WHERE chat_id = %s AND status IN ('pending', 'failed');
+    """, (chat_id,))
+    return cur.rowcount
+
+# Function to transfer a prize to the winner's wallet (only accepts USDT)
+async def transfer_to_winner(chat_id, amount, asset, spend_id):
+    # Fetch the wallet address (from this process's user cache when the winner was seen recently)
+    wallet_address = (await user_cache.get_user(chat_id))['wallet']
+    if not wallet_address:
+        logging.error(f"User ID {chat_id} has not set a wallet address.")
+        return False, "No wallet address found. Please set your wallet address using /set_wallet."
+
+    payload = {
+        'user_id': wallet_address,
+        'asset': asset,
+        'amount': str(amount),
+        'spend_id': spend_id,
+        'comment': 'Congratulations! You have won the lucky draw!'
+    }
+
+    try:
+        response = await cryptobot.call('transfer', payload)
+    except cryptobot.CryptoBotError as e:
+        logging.error(f"Failed to transfer to winner: {e}")
+        return False, "Transfer failed. Please try again later."
+
+    if not response.get('ok'):
+        error = response.get('error', {})
+        # A retry after a lost response: CryptoBot already executed this spend_id
+        if 'SPEND_ID' in str(error.get('name', '')).upper():
+            logging.info(f"Transfer {spend_id} was already executed.")
+            return True, None
+        error_message = error.get('message') or error.get('name') or 'Unknown error'
+        logging.error(f"Error during transfer: {error_message}")
+        return False, error_message
+
+    logging.info(f"Successfully transferred {amount} {asset} to wallet address {wallet_address}.")
+    return True, None
+
+async def _process(bot, job):
+    payout_id, pool_name, chat_id, amount, asset, spend_id, attempts = job
+    success, error_message = await transfer_to_winner(chat_id, amount, asset, spend_id)
+
+    if success:
+        await db.run_transaction(_mark_paid, payout_id, chat_id, amount, asset)
+        await bot.send_message(chat_id=chat_id, text=f"Congratulations! You won ${amount:.2f} in the {pool_name}!",
+                               rate_limit_args={'priority': outbox.TRANSACTIONAL})
+        return
+
+    await db.run_transaction(_mark_retry, payout_id, attempts, error_message)
+    logging.error(f"Payout {payout_id} attempt {attempts} failed: {error_message}")
+    if attempts == 1:
+        await bot.send_message(chat_id=chat_id, text=(
+            f"You won the {pool_name}, but we could not send your prize yet: {error_message}\n"
+            "We will retry automatically."
+        ), rate_limit_args={'priority': outbox.TRANSACTIONAL})
+
+# Pay out every due job, one at a time
+async def drain(bot):
+    while True:
+        job = await db.run_transaction(_claim)
+        if job is None:
+            return
+        try:
+            await _process(bot, job)
+        except Exception as e:
+            # The lease expires and another pass retries the job
+            logging.error(f"Error while processing payout {job[0]}: {e}")
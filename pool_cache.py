@@ -0,0 +1,103 @@
+import os
+import time
+import asyncio
+import db
+import metrics
+
+# Safety net: the snapshot is reloaded from the database at least this often
+POOL_CACHE_TTL = float(os.getenv('POOL_CACHE_TTL', '30'))
+
+# Process-local snapshot: pool_name -> {'amount': ..., 'participants': ..., 'opens_at': ..., 'closes_at': ...}
+_snapshot = {}
+_loaded_at = None
+_refresh_lock = asyncio.Lock()
+# Bumped whenever a cached amount, count or open/close time changes, so rendered replies can be reused
+_version = 0
+
+_stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+
+# Participant counts are counters kept on the pools rows and the open/close times live on the
+# current pool_rounds row, so this is one O(pools) query
+def _load(cur):
+    cur.execute("""
+        SELECT p.pool_name, p.pool_amount, p.participant_count, r.opens_at, r.closes_at
+        FROM pools p
+        LEFT JOIN pool_rounds r ON r.pool_name = p.pool_name AND r.round_id = p.round_id;
+    """)
+    return {
+        name: {'amount': amount, 'participants': count, 'opens_at': opens_at, 'closes_at': closes_at}
+        for name, amount, count, opens_at, closes_at in cur.fetchall()
+    }
+
+def _is_fresh():
+    return _loaded_at is not None and time.monotonic() - _loaded_at < POOL_CACHE_TTL
+
+async def _refresh():
+    global _snapshot, _loaded_at, _version
+    async with _refresh_lock:
+        # Another caller may have refreshed while we were waiting for the lock
+        if _is_fresh():
+            return
+        snapshot = await db.run_transaction(_load)
+        if snapshot != _snapshot:
+            _version += 1
+        _snapshot = snapshot
+        _loaded_at = time.monotonic()
+        _stats['refreshes'] += 1
+
+def _changed():
+    global _version
+    _version += 1
+
+def _empty():
+    return {'amount': 0, 'participants': 0, 'opens_at': None, 'closes_at': None}
+
+def _entry(pool_name):
+    return dict(_snapshot.get(pool_name) or _empty())
+
+async def _ensure_fresh():
+    if _is_fresh():
+        _stats['hits'] += 1
+    else:
+        _stats['misses'] += 1
+        await _refresh()
+
+# Return the cached state of the given pools, reloading from the database only when stale
+async def get_pools(pool_names):
+    await _ensure_fresh()
+    return {name: _entry(name) for name in pool_names}
+
+# Current state version (reloading first if stale); equal versions mean identical pool state
+async def get_version():
+    await _ensure_fresh()
+    return _version
+
+# Called after a payment is confirmed
+def record_participants(pool_name, count=1, amount=0):
+    _changed()
+    if pool_name in _snapshot:
+        _snapshot[pool_name]['participants'] += count
+        _snapshot[pool_name]['amount'] += amount
+    elif _loaded_at is not None:
+        _snapshot[pool_name] = dict(_empty(), participants=count, amount=amount)
+
+# Called when end_specific_pool resets a pool; the next round has not opened yet
+def reset_pool(pool_name, opens_at=None):
+    _changed()
+    if pool_name in _snapshot:
+        _snapshot[pool_name].update(amount=0, participants=0, opens_at=opens_at, closes_at=None)
+
+# Write-through after a round's times are saved, so this replica sees them before the next reload
+def set_schedule(pool_name, opens_at=None, closes_at=None):
+    _changed()
+    if pool_name in _snapshot:
+        _snapshot[pool_name].update(opens_at=opens_at, closes_at=closes_at)
+
+def invalidate():
+    global _loaded_at
+    _loaded_at = None
+
+def get_stats():
+    return dict(_stats)
+
+metrics.register_collector(lambda: {(f'pool_cache_{name}', None): value for name, value in get_stats().items()})
@@ -0,0 +1,50 @@
+import os
+import json
+import logging
+from datetime import timedelta
+from apscheduler.triggers.cron import CronTrigger
+
+# Timezone the pool schedules are written in
+POOL_TIMEZONE = os.getenv('POOL_TIMEZONE', 'Asia/Kolkata')
+# Optional JSON file with a list of pool definitions that replaces the defaults below
+POOLS_FILE = os.getenv('POOLS_FILE')
+
+# One pool tier. `schedule` is a crontab expression for when a round opens; the round closes
+# `duration_minutes` later. `key` is used in /join_<key> and in scheduler job ids.
+# The prize (pot minus the cut) is split equally between `winners` distinct participants.
+class Pool:
+    def __init__(self, key, name, emoji, entry_fee, schedule, duration_minutes, cut_percentage=10, description='', winners=1):
+        self.key = key
+        self.name = name
+        self.emoji = emoji
+        self.entry_fee = float(entry_fee)
+        self.schedule = schedule
+        self.duration = timedelta(minutes=duration_minutes)
+        self.cut_percentage = cut_percentage
+        self.description = description
+        self.winners = winners
+        self.trigger = CronTrigger.from_crontab(schedule, timezone=POOL_TIMEZONE)
+        self.command = f'join_{key}'
+        self.button = f"{emoji} Join {name.removesuffix(' Pool')}"
+
+DEFAULT_POOLS = [
+    {'key': 'bronze', 'name': 'Bronze Pool', 'emoji': '🥉', 'entry_fee': 10, 'schedule': '0 0 * * *',
+     'duration_minutes': 1439, 'description': 'opens every 24 hours and runs for a full day'},
+    {'key': 'silver', 'name': 'Silver Pool', 'emoji': '🥈', 'entry_fee': 25, 'schedule': '0 0 */3 * *',
+     'duration_minutes': 1439, 'description': 'opens every 3 days and runs for 24 hours'},
+    {'key': 'gold', 'name': 'Gold Pool', 'emoji': '🥇', 'entry_fee': 50, 'schedule': '0 0 * * sun',
+     'duration_minutes': 1439, 'description': 'opens every Sunday and runs for 24 hours'},
+]
+
+def _load():
+    definitions = DEFAULT_POOLS
+    if POOLS_FILE:
+        with open(POOLS_FILE) as f:
+            definitions = json.load(f)
+        logging.info(f"Loaded {len(definitions)} pool definitions from {POOLS_FILE}")
+    return [Pool(**definition) for definition in definitions]
+
+POOLS = _load()
+by_name = {pool.name: pool for pool in POOLS}
+by_key = {pool.key: pool for pool in POOLS}
+POOL_NAMES = tuple(by_name)
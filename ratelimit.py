@@ -0,0 +1,80 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+# Async token bucket: allows `rate` acquisitions per second with bursts up to `capacity`.
+# pause() stops all acquisitions for a while, e.g. when Telegram answers with retry_after.
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # Nothing accumulates while paused
+        self.tokens = 0
+        self.updated = self.paused_until
+
+# Token buckets kept per key (e.g. per chat): each key may take `rate` tokens per second with bursts
+# up to `capacity`. Not awaitable; callers decide whether to drop, defer or wait. Buckets of the least
+# recently used keys are dropped beyond max_keys (such a key starts again with a full bucket).
+class KeyedTokenBuckets:
+    def __init__(self, rate, capacity, max_keys=100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        # key -> (tokens, last update), least recently used first
+        self._buckets = OrderedDict()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def _store(self, key, tokens, now):
+        self._buckets.pop(key, None)
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    # Seconds until the key may take a token (0 if it may now)
+    def wait_time(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        tokens = self._tokens(key, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    # Take one token if the key has one; returns whether it did
+    def try_take(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        tokens = self._tokens(key, now)
+        allowed = tokens >= 1
+        self._store(key, tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    # No tokens for the key for this many seconds
+    def pause(self, key, seconds):
+        now = time.monotonic()
+        self._store(key, min(self._tokens(key, now), 1 - seconds * self.rate), now)
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,113 @@
+import os
+import math
+import asyncio
+import hashlib
+import logging
+from psycopg2.extras import execute_values
+import db
+import metrics
+
+# New chat_ids are written in one multi-row upsert every REGISTRATION_FLUSH_MS or as soon as
+# REGISTRATION_BATCH_SIZE of them are waiting, whichever comes first
+REGISTRATION_FLUSH_MS = float(os.getenv('REGISTRATION_FLUSH_MS', '200'))
+REGISTRATION_BATCH_SIZE = int(os.getenv('REGISTRATION_BATCH_SIZE', '500'))
+# Size of the known-users filter; it is cleared once this many users were added to keep the
+# false-positive rate (a new user wrongly treated as registered) at KNOWN_USERS_ERROR_RATE
+KNOWN_USERS_CAPACITY = int(os.getenv('KNOWN_USERS_CAPACITY', '1000000'))
+KNOWN_USERS_ERROR_RATE = 1e-6
+
+# Fixed-size set membership with no false negatives and a bounded false-positive rate
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    # Double hashing: k positions derived from one 128-bit digest
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+
+known_users = BloomFilter(KNOWN_USERS_CAPACITY, KNOWN_USERS_ERROR_RATE)
+
+# chat_ids waiting for the next flush
+_pending = set()
+_batch_full = asyncio.Event()
+_flush_task = None
+
+_stats = {'known': 0, 'queued': 0, 'registered': 0, 'flushes': 0}
+
+def _insert_users(cur, chat_ids):
+    execute_values(cur, """
+        INSERT INTO users (chat_id) VALUES %s
+        ON CONFLICT (chat_id) DO NOTHING;
+    """, [(chat_id,) for chat_id in chat_ids], page_size=REGISTRATION_BATCH_SIZE)
+
+def _remember(chat_ids):
+    for chat_id in chat_ids:
+        if known_users.count >= KNOWN_USERS_CAPACITY:
+            # Start over; returning users cost one more (batched) upsert each
+            known_users.clear()
+        known_users.add(chat_id)
+
+# Write every waiting chat_id; on failure they stay queued for the next flush
+async def flush():
+    if not _pending:
+        return
+    # Sorted so concurrent flushes on several replicas lock rows in the same order
+    chat_ids = sorted(_pending)
+    _pending.clear()
+    try:
+        await db.run_transaction(_insert_users, chat_ids)
+    except Exception as e:
+        logging.error(f"Database error while registering {len(chat_ids)} users: {e}")
+        _pending.update(chat_ids)
+        return
+    _remember(chat_ids)
+    _stats['registered'] += len(chat_ids)
+    _stats['flushes'] += 1
+
+async def _flush_loop():
+    while _pending:
+        try:
+            await asyncio.wait_for(_batch_full.wait(), REGISTRATION_FLUSH_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _batch_full.clear()
+        await flush()
+
+# Queue a user for registration without waiting for the database. Users already known to this
+# process are skipped entirely. Anything still queued when the process dies is lost, at most
+# one flush interval's worth; those users are registered again on their next /start.
+def register(chat_id):
+    global _flush_task
+    if chat_id in known_users:
+        _stats['known'] += 1
+        return
+    _stats['queued'] += 1
+    _pending.add(chat_id)
+    if len(_pending) >= REGISTRATION_BATCH_SIZE:
+        _batch_full.set()
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_loop())
+
+def get_stats():
+    return dict(_stats, pending=len(_pending))
+
+metrics.register_collector(lambda: {(f'registration_{name}', None): value for name, value in get_stats().items()})
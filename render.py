@@ -0,0 +1,139 @@
+import time
+from datetime import datetime, timezone
+from telegram import ReplyKeyboardMarkup
+import metrics
+import pool_cache
+import pool_registry
+
+# Static replies and the keyboard only depend on the pool registry, so they are built once at import.
+# Pool-dependent replies are cached per pool-state version (and per minute where they show times).
+
+_stats = {'hits': 0, 'misses': 0}
+# kind -> (cache key, text)
+_cache = {}
+
+# Helper function to format the time remaining
+def format_time_remaining(time_remaining):
+    days, seconds = time_remaining.days, time_remaining.seconds
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    if days > 0:
+        return f"{days}d {hours}h {minutes}m"
+    elif hours > 0:
+        return f"{hours}h {minutes}m"
+    else:
+        return f"{minutes}m"
+
+def _build_keyboard():
+    # Define the custom keyboard layout using emojis (one join button per pool, three per row)
+    join_buttons = [pool.button for pool in pool_registry.POOLS]
+    keyboard = [
+        ["📜 Rules", "📊 Status"],
+        *[join_buttons[i:i + 3] for i in range(0, len(join_buttons), 3)],
+        ["👥 Players", "ℹ️ My Info"],
+        ["💰 Pool Size", "🆘 Help"],
+        ["👛 Set Wallet"]
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+
+def _build_rules():
+    pools = pool_registry.POOLS
+    rules_lines = [
+        f"The {pool.name} {pool.description}. Entry fee: ${pool.entry_fee:g}. Use /{pool.command} to participate."
+        for pool in pools
+    ]
+    cuts = {pool.cut_percentage for pool in pools}
+    if len(cuts) == 1:
+        cut_text = f"a {cuts.pop()}% bot cut"
+    else:
+        cut_text = "the pool's bot cut (" + ", ".join(f"{pool.name}: {pool.cut_percentage}%" for pool in pools) + ")"
+    if all(pool.winners == 1 for pool in pools):
+        draw_text = "a winner will be randomly selected"
+        prize_text = f"The prize is transferred to the winner after {cut_text}."
+    else:
+        draw_text = "winners will be randomly selected (" + ", ".join(f"{pool.name}: {pool.winners}" for pool in pools) + ")"
+        prize_text = f"The prize is shared equally between the winners after {cut_text}."
+    rules_lines += [
+        f"At the end of each pool's duration, {draw_text}, with one ticket per cent paid.",
+        "Every draw can be verified: a commitment to the draw secret is announced when a pool opens and the secret when it closes.",
+        prize_text,
+        "Payments are handled via CryptoBot, and only USDT is accepted for all transactions.",
+        "Make sure to join only one pool per cycle. Once you join, you cannot join the same pool until it resets.",
+    ]
+    return "Welcome to the Lucky Draw Pool!\n" + "\n".join(f"{i}. {line}" for i, line in enumerate(rules_lines, 1))
+
+def _build_help():
+    return (
+        "Here are the available commands:\n"
+        "/start - Start interacting with the bot and see basic instructions.\n"
+        "/rules - Learn how the lucky draw pools work, including entry fees and pool timings.\n"
+        + "".join(f"/{pool.command} - Join the {pool.name} (${pool.entry_fee:g} entry fee).\n" for pool in pool_registry.POOLS) +
+        "/players - View the number of participants in each pool.\n"
+        "/my_info - See your participation status in the pools.\n"
+        "/pool_size - View the current size of each pool in dollars.\n"
+        "/status - Check the status of each pool, including whether they are open or closed, the current size, and the time left until they close or reopen.\n"
+        "/help - Display this list of commands with their descriptions.\n"
+        "/set_wallet - Set a wallet where the winning amount will be transferred"
+    )
+
+KEYBOARD = _build_keyboard()
+WELCOME_MESSAGE = (
+    "🎉 Welcome to the Lucky Draw Pool Bot! 🎉\n\n"
+    "Use the buttons below to navigate through the commands.\n"
+    "You can join pools, check pool status, view rules, and more!"
+)
+RULES_TEXT = _build_rules()
+HELP_TEXT = _build_help()
+
+def _build_status(pools, now):
+    status_lines = []
+    for name in pool_registry.POOL_NAMES:
+        pool = pools[name]
+        pool_status = "Open" if pool['opens_at'] and pool['closes_at'] and pool['opens_at'] <= now < pool['closes_at'] else "Closed"
+        if pool_status == "Open":
+            pool_info = f"Closes in: {format_time_remaining(pool['closes_at'] - now)}"
+        elif pool['opens_at']:
+            pool_info = f"Opens in: {format_time_remaining(pool['opens_at'] - now)}"
+        else:
+            pool_info = "N/A"
+        status_lines.append(f"{name}: {pool_status}, Current Size: ${pool['amount']:.2f}\n    {pool_info}\n")
+    return "🟢 **Pool Status** 🟢\n" + "".join(status_lines)
+
+def _build_players(pools, now):
+    return "Current Players:\n" + "\n".join(
+        f"{name}: {pools[name]['participants']} players" for name in pool_registry.POOL_NAMES
+    )
+
+def _build_pool_size(pools, now):
+    return "Current Pool Sizes:\n" + "\n".join(
+        f"{name}: ${pools[name]['amount']:.2f}" for name in pool_registry.POOL_NAMES
+    )
+
+# Return the cached text for `kind`, rebuilding it only when the pool state version
+# (or, if per_minute, the current minute) has changed since it was built
+async def _render(kind, build, per_minute=False):
+    version = await pool_cache.get_version()
+    key = (version, int(time.time() // 60) if per_minute else None)
+    cached = _cache.get(kind)
+    if cached is not None and cached[0] == key:
+        _stats['hits'] += 1
+        return cached[1]
+    _stats['misses'] += 1
+    pools = await pool_cache.get_pools(pool_registry.POOL_NAMES)
+    text = build(pools, datetime.now(timezone.utc))
+    _cache[kind] = (key, text)
+    return text
+
+async def status_text():
+    return await _render('status', _build_status, per_minute=True)
+
+async def players_text():
+    return await _render('players', _build_players)
+
+async def pool_size_text():
+    return await _render('pool_size', _build_pool_size)
+
+def get_stats():
+    return dict(_stats)
+
+metrics.register_collector(lambda: {(f'render_cache_{name}', None): value for name, value in get_stats().items()})
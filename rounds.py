@@ -0,0 +1,114 @@
+import db
+import draw
+import user_cache
+
+# Rows fetched per round trip when streaming a round's participants
+PARTICIPANT_CHUNK_SIZE = 500
+
+# Make sure every configured pool has a row (pools added to the registry start at round 1)
+def _ensure_pools(cur, pool_names):
+    cur.execute("""
+        INSERT INTO pools (pool_name, pool_amount)
+        SELECT name, 0 FROM unnest(%s::text[]) AS name
+        ON CONFLICT (pool_name) DO NOTHING;
+        INSERT INTO pool_rounds (pool_name, round_id)
+        SELECT pool_name, round_id FROM pools WHERE pool_name = ANY(%s::text[])
+        ON CONFLICT DO NOTHING;
+    """, (list(pool_names), list(pool_names)))
+
+async def ensure_pools(pool_names):
+    await db.run_transaction(_ensure_pools, pool_names)
+
+# Closing times of the current rounds that are open, as pool_name -> closes_at
+async def get_open_rounds():
+    rows = await db.fetchall("""
+        SELECT r.pool_name, r.closes_at FROM pools p
+        JOIN pool_rounds r ON r.pool_name = p.pool_name AND r.round_id = p.round_id
+        WHERE r.state = 'open';
+    """)
+    return dict(rows)
+
+# Close the current round of a pool and open the next one (runs inside one transaction).
+# Returns the closed round's id and pot, or None if the pool does not exist. The pot is kept on the
+# closed round until payouts.settle_round turns it into payouts.
+# The next round is recorded as scheduled to open at next_opens_at.
+def _close_round(cur, pool_name, next_opens_at):
+    cur.execute("""
+        UPDATE pools SET pool_amount = 0, participant_count = 0, ticket_count = 0, round_id = pools.round_id + 1
+        FROM (SELECT round_id, pool_amount FROM pools WHERE pool_name = %s FOR UPDATE) AS closed
+        WHERE pools.pool_name = %s
+        RETURNING closed.round_id, closed.pool_amount;
+    """, (pool_name, pool_name))
+    closed = cur.fetchone()
+    if closed is None:
+        return None
+    cur.execute("""
+        INSERT INTO pool_rounds (pool_name, round_id, state, closes_at, pot)
+        VALUES (%s, %s, 'closed', now(), %s)
+        ON CONFLICT (pool_name, round_id) DO UPDATE SET state = 'closed', closes_at = now(), pot = EXCLUDED.pot;
+        INSERT INTO pool_rounds (pool_name, round_id, opens_at)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (pool_name, round_id) DO UPDATE SET opens_at = EXCLUDED.opens_at;
+    """, (pool_name, closed[0], closed[1], pool_name, closed[0] + 1, next_opens_at))
+    user_cache.notify_pool_reset(cur, pool_name)
+    return closed
+
+async def close_round(pool_name, next_opens_at=None):
+    closed = await db.run_transaction(_close_round, pool_name, next_opens_at)
+    user_cache.reset_pool(pool_name)
+    return closed
+
+# Mark the current round of a pool as open until closes_at and commit to its draw secret
+# (a round that is opened again keeps its first secret). Returns the opening time and the commitment.
+def _open_round(cur, pool_name, closes_at):
+    secret, seed_commitment = draw.new_secret()
+    cur.execute("""
+        INSERT INTO pool_rounds (pool_name, round_id, state, opens_at, closes_at, seed_secret, seed_commitment)
+        SELECT pool_name, round_id, 'open', now(), %s, %s, %s FROM pools WHERE pool_name = %s
+        ON CONFLICT (pool_name, round_id) DO UPDATE
+        SET state = 'open', opens_at = EXCLUDED.opens_at, closes_at = EXCLUDED.closes_at,
+            seed_secret = COALESCE(pool_rounds.seed_secret, EXCLUDED.seed_secret),
+            seed_commitment = COALESCE(pool_rounds.seed_commitment, EXCLUDED.seed_commitment)
+        RETURNING opens_at, seed_commitment;
+    """, (closes_at, secret, seed_commitment, pool_name))
+    return cur.fetchone() or (None, None)
+
+async def open_round(pool_name, closes_at):
+    return await db.run_transaction(_open_round, pool_name, closes_at)
+
+# Fill in the opening time of a round that is still waiting to open, e.g. on first boot
+# or when its start job was missed without a record in the job store
+def _schedule_round(cur, pool_name, opens_at):
+    cur.execute("""
+        INSERT INTO pool_rounds (pool_name, round_id, opens_at)
+        SELECT pool_name, round_id, %s FROM pools WHERE pool_name = %s
+        ON CONFLICT (pool_name, round_id) DO UPDATE SET opens_at = EXCLUDED.opens_at
+        WHERE pool_rounds.state = 'scheduled'
+          AND (pool_rounds.opens_at IS NULL OR pool_rounds.opens_at < now());
+    """, (opens_at, pool_name))
+
+async def schedule_round(pool_name, opens_at):
+    await db.run_transaction(_schedule_round, pool_name, opens_at)
+
+# Yield the distinct chat_ids of a round in chunks (keyset pagination on the (pool_name, round_id, chat_id) index).
+# Rounds are only archived once settled, so their entries are still in the active partition.
+async def iter_participants(pool_name, round_id, chunk_size=PARTICIPANT_CHUNK_SIZE):
+    last_chat_id = None
+    while True:
+        if last_chat_id is None:
+            rows = await db.fetchall("""
+                SELECT DISTINCT chat_id FROM pool_participants
+                WHERE pool_name = %s AND round_id = %s AND archived_month = 'infinity'
+                ORDER BY chat_id LIMIT %s;
+            """, (pool_name, round_id, chunk_size))
+        else:
+            rows = await db.fetchall("""
+                SELECT DISTINCT chat_id FROM pool_participants
+                WHERE pool_name = %s AND round_id = %s AND chat_id > %s AND archived_month = 'infinity'
+                ORDER BY chat_id LIMIT %s;
+            """, (pool_name, round_id, last_chat_id, chunk_size))
+        if not rows:
+            return
+        chat_ids = [row[0] for row in rows]
+        last_chat_id = chat_ids[-1]
+        yield chat_ids
@@ -0,0 +1,48 @@
+import os
+import time
+import logging
+
+# Startup-time breakdown: each mark() records the time spent since the previous one.
+# Imported first by the bot so the clock starts before the heavy imports (metrics included).
+_started = time.perf_counter()
+import metrics
+_last = _started
+_phases = []
+_first_update_seconds = None
+
+# Seconds between the process being created and this module being imported (Linux only)
+def _interpreter_startup():
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK') - (time.perf_counter() - _started))
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+_interpreter_seconds = _interpreter_startup()
+
+# Time since the process was started
+def elapsed():
+    return _interpreter_seconds + time.perf_counter() - _started
+
+def mark(phase):
+    global _last
+    now = time.perf_counter()
+    seconds = now - _last
+    _last = now
+    _phases.append((phase, seconds))
+    metrics.set_gauge('startup_phase_seconds', seconds, {'phase': phase})
+
+def report():
+    breakdown = ', '.join(f"{phase} {seconds:.3f}s" for phase, seconds in [('interpreter', _interpreter_seconds)] + _phases)
+    logging.info(f"Ready {elapsed():.3f}s after process start ({breakdown})")
+
+# Registered as the last handler group, so it runs once the first update has been handled
+async def on_update_handled(update, context):
+    global _first_update_seconds
+    if _first_update_seconds is None:
+        _first_update_seconds = elapsed()
+        metrics.set_gauge('startup_first_update_seconds', _first_update_seconds)
+        logging.info(f"First update handled {_first_update_seconds:.3f}s after process start.")
@@ -0,0 +1,75 @@
+import os
+import sys
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import draw
+
+SECRET = 'ab' * 32
+# (invoice_id, chat_id, first_ticket, tickets): one ticket per cent paid, numbered in invoice_id order
+ENTRIES = [
+    (101, 1, 0, 1000),
+    (102, 2, 1000, 2500),
+    (105, 3, 3500, 1000),
+    (107, 1, 4500, 500),
+    (110, 4, 5000, 5000),
+]
+
+# Answers the queries draw_round runs from ENTRIES and keeps what it stores on the round
+class FakeCursor:
+    def __init__(self, entries, secret):
+        self.entries = entries
+        self.secret = secret
+        self.stored = None
+        self.result = None
+
+    def execute(self, query, params):
+        if 'FOR UPDATE' in query:
+            self.result = (self.secret, None)
+        elif 'SUM(tickets)' in query:
+            ids = ','.join(str(entry[0]) for entry in sorted(self.entries))
+            self.result = (sum(entry[3] for entry in self.entries), len({entry[1] for entry in self.entries}),
+                           hashlib.sha256(ids.encode()).hexdigest())
+        elif 'first_ticket <=' in query:
+            ticket = params[2]
+            self.result = (max((entry for entry in self.entries if entry[2] <= ticket), key=lambda entry: entry[2])[1],)
+        elif query.strip().startswith('UPDATE pool_rounds'):
+            secret, seed, total_tickets, winning_tickets, winners = params[:5]
+            self.stored = {'seed_secret': secret, 'draw_seed': seed, 'total_tickets': total_tickets,
+                           'winning_tickets': winning_tickets, 'winner_chat_ids': winners}
+        else:
+            raise AssertionError(f"unexpected query: {query}")
+
+    def fetchone(self):
+        return self.result
+
+class DrawTest(unittest.TestCase):
+    def test_stored_draw_is_reproducible_offline(self):
+        cur = FakeCursor(ENTRIES, SECRET)
+        winners, secret = draw.draw_round(cur, 'Bronze Pool', 7, 3)
+        stored = cur.stored
+
+        # Only the published values are used from here on
+        self.assertEqual(draw.commitment(stored['seed_secret']), draw.commitment(SECRET))
+        seed, winning_tickets, recomputed_winners = draw.recompute(stored['seed_secret'], 'Bronze Pool', 7, ENTRIES, 3)
+        self.assertEqual(seed, stored['draw_seed'])
+        self.assertEqual(winning_tickets, stored['winning_tickets'])
+        self.assertEqual(recomputed_winners, stored['winner_chat_ids'])
+        self.assertEqual(recomputed_winners, winners)
+        self.assertEqual(stored['total_tickets'], 10000)
+        self.assertEqual(len(set(winners)), 3)
+
+    def test_seed_covers_every_entry(self):
+        seed = draw.recompute(SECRET, 'Bronze Pool', 7, ENTRIES)[0]
+        self.assertNotEqual(seed, draw.recompute(SECRET, 'Bronze Pool', 7, ENTRIES[:-1])[0])
+        self.assertNotEqual(seed, draw.recompute(SECRET, 'Bronze Pool', 8, ENTRIES)[0])
+        self.assertNotEqual(seed, draw.recompute('cd' * 32, 'Bronze Pool', 7, ENTRIES)[0])
+
+    def test_ticket_stream_stays_in_range(self):
+        tickets = draw.ticket_stream(hashlib.sha256(b'seed').hexdigest(), 3)
+        values = [next(tickets) for _ in range(300)]
+        self.assertEqual(set(values), {0, 1, 2})
+
+if __name__ == '__main__':
+    unittest.main()
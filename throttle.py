@@ -0,0 +1,29 @@
+import os
+import logging
+import metrics
+import ratelimit
+
+# Per-chat token bucket: sustained button presses per second and the allowed burst
+USER_RATE_LIMIT = float(os.getenv('USER_RATE_LIMIT', '1'))
+USER_RATE_BURST = float(os.getenv('USER_RATE_BURST', '5'))
+# Buckets of the least recently active chats are dropped beyond this many
+MAX_TRACKED_CHATS = 100000
+
+_buckets = ratelimit.KeyedTokenBuckets(USER_RATE_LIMIT, USER_RATE_BURST, MAX_TRACKED_CHATS)
+
+_stats = {'allowed': 0, 'throttled': 0}
+
+# Take one token from the chat's bucket; False means the update should be dropped
+def allow(chat_id):
+    allowed = _buckets.try_take(chat_id)
+    if allowed:
+        _stats['allowed'] += 1
+    else:
+        _stats['throttled'] += 1
+        logging.debug(f"Throttled update from chat_id {chat_id}")
+    return allowed
+
+def get_stats():
+    return dict(_stats, tracked_chats=len(_buckets))
+
+metrics.register_collector(lambda: {(f'throttle_{name}', None): value for name, value in get_stats().items()})
@@ -0,0 +1,108 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+# Updates handled at the same time. Updates from one chat are always handled one after another,
+# in the order they arrived, so at most one update per chat counts towards this limit.
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))
+# Updates allowed to wait for their turn; beyond this new updates are dropped
+UPDATE_BACKLOG_LIMIT = int(os.getenv('UPDATE_BACKLOG_LIMIT', '10000'))
+
+# Processes updates from different chats concurrently while keeping each chat's updates in order.
+# An update for a chat that is already being handled is appended to that chat's queue and handled by
+# the same task right after, so a busy chat holds one slot instead of blocking others behind it.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, backlog_limit=UPDATE_BACKLOG_LIMIT):
+        # PTB's own semaphore admits running and waiting updates; the real limit is self._slots
+        super().__init__(max_concurrent_updates + backlog_limit)
+        self.concurrency = max_concurrent_updates
+        self.backlog_limit = backlog_limit
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat_id -> deque of (coroutine, received at) for updates waiting behind the chat's running update
+        self._chats = {}
+        self._waiting = 0
+        self._queued = 0
+        self._running = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._stats = {'processed': 0, 'dropped': 0, 'errors': 0}
+
+    @property
+    def backlog(self):
+        return self._waiting + self._queued
+
+    async def initialize(self):
+        pass
+
+    # Let updates that are already admitted finish
+    async def shutdown(self):
+        await self._idle.wait()
+
+    async def _run(self, coroutine, received):
+        metrics.observe('update_wait_seconds', time.perf_counter() - received)
+        try:
+            await coroutine
+        except Exception as e:
+            # Handler errors are reported by the application; this only catches failures around them
+            self._stats['errors'] += 1
+            logging.error(f"Error while processing an update: {e}")
+        self._stats['processed'] += 1
+
+    async def do_process_update(self, update, coroutine):
+        received = time.perf_counter()
+        if self.backlog >= self.backlog_limit:
+            coroutine.close()
+            self._stats['dropped'] += 1
+            logging.debug("Update backlog is full, dropping an update.")
+            return
+
+        chat = update.effective_chat if isinstance(update, Update) else None
+        chat_id = chat.id if chat else None
+        if chat_id in self._chats:
+            self._chats[chat_id].append((coroutine, received))
+            self._queued += 1
+            return
+
+        queue = deque()
+        if chat_id is not None:
+            self._chats[chat_id] = queue
+        self._idle.clear()
+        self._waiting += 1
+        try:
+            try:
+                await self._slots.acquire()
+            except BaseException:
+                coroutine.close()
+                raise
+            finally:
+                self._waiting -= 1
+            self._running += 1
+            try:
+                await self._run(coroutine, received)
+                while queue:
+                    self._queued -= 1
+                    await self._run(*queue.popleft())
+            finally:
+                self._running -= 1
+                self._slots.release()
+        finally:
+            # Only reached with updates left over if this task was cancelled
+            while queue:
+                self._queued -= 1
+                queue.popleft()[0].close()
+            if chat_id is not None:
+                self._chats.pop(chat_id, None)
+            if not self._running and not self.backlog:
+                self._idle.set()
+
+    def get_stats(self):
+        return dict(self._stats, running=self._running, backlog=self.backlog, busy_chats=len(self._chats))
+
+processor = ChatOrderedUpdateProcessor()
+
+metrics.register_collector(lambda: {(f'updates_{name}', None): value for name, value in processor.get_stats().items()})
@@ -0,0 +1,177 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+import psycopg2
+import db
+import metrics
+
+# Users whose records are kept in memory (least recently used are evicted beyond this)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '100000'))
+# Every process LISTENs on this channel; writers NOTIFY it inside their transaction, so the
+# notification goes out exactly when the write commits
+USER_CACHE_CHANNEL = 'user_cache'
+# How often the listening connection is checked, and how long to wait before reconnecting it
+USER_CACHE_PING_INTERVAL = 30
+USER_CACHE_RECONNECT_DELAY = 5
+# NOTIFY payloads must stay under 8000 bytes
+NOTIFY_BATCH_SIZE = 500
+
+# chat_id -> {'wallet': ..., 'memberships': {pool_name: invoice_id}} for the current rounds
+_cache = OrderedDict()
+# Bumped by every invalidation; a load that overlapped one is not stored, since it may predate the write
+_invalidations = 0
+_conn = None
+# The listening connection's socket (psycopg2 no longer reports it once the connection broke)
+_fd = None
+_listening = False
+_task = None
+
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0, 'connects': 0}
+
+# Called inside a writing transaction: every process drops these users once it commits
+def notify_users(cur, chat_ids):
+    chat_ids = sorted(set(chat_ids))
+    for start in range(0, len(chat_ids), NOTIFY_BATCH_SIZE):
+        payload = 'user:' + ','.join(str(chat_id) for chat_id in chat_ids[start:start + NOTIFY_BATCH_SIZE])
+        cur.execute("SELECT pg_notify(%s, %s);", (USER_CACHE_CHANNEL, payload))
+
+# Called inside the transaction that closes a round: memberships of that pool are gone everywhere
+def notify_pool_reset(cur, pool_name):
+    cur.execute("SELECT pg_notify(%s, %s);", (USER_CACHE_CHANNEL, f'pool:{pool_name}'))
+
+def invalidate_users(chat_ids):
+    global _invalidations
+    _invalidations += 1
+    for chat_id in chat_ids:
+        if _cache.pop(chat_id, None) is not None:
+            _stats['invalidations'] += 1
+
+def reset_pool(pool_name):
+    global _invalidations
+    _invalidations += 1
+    for record in _cache.values():
+        record['memberships'].pop(pool_name, None)
+
+def clear():
+    global _invalidations
+    _invalidations += 1
+    _cache.clear()
+
+def _load_user(cur, chat_id):
+    cur.execute("SELECT wallet_address FROM users WHERE chat_id = %s;", (chat_id,))
+    row = cur.fetchone()
+    cur.execute("""
+        SELECT pp.pool_name, pp.invoice_id FROM pool_participants pp
+        JOIN pools p ON p.pool_name = pp.pool_name AND p.round_id = pp.round_id
+        WHERE pp.chat_id = %s AND pp.archived_month = 'infinity';
+    """, (chat_id,))
+    return {'wallet': row[0] if row else None, 'memberships': dict(cur.fetchall())}
+
+# A user's wallet and current-round memberships. Loaded from the primary, since a lagging replica
+# could hand back data older than an invalidation that was already processed.
+async def get_user(chat_id):
+    record = _cache.get(chat_id)
+    if record is not None:
+        _cache.move_to_end(chat_id)
+        _stats['hits'] += 1
+        return record
+    _stats['misses'] += 1
+    invalidations = _invalidations
+    record = await db.run_transaction(_load_user, chat_id)
+    # Without a listener, writes from other processes would go unnoticed, so nothing is kept
+    if _listening and invalidations == _invalidations:
+        _cache[chat_id] = record
+        if len(_cache) > USER_CACHE_SIZE:
+            _cache.popitem(last=False)
+            _stats['evictions'] += 1
+    return record
+
+def _handle(payload):
+    kind, _, value = payload.partition(':')
+    if kind == 'user':
+        invalidate_users(int(chat_id) for chat_id in value.split(','))
+    elif kind == 'pool':
+        reset_pool(value)
+    else:
+        logging.warning(f"Unknown user cache notification: {payload}")
+
+def _on_readable():
+    try:
+        _conn.poll()
+    except psycopg2.Error as e:
+        _disconnect(e)
+        return
+    while _conn.notifies:
+        _handle(_conn.notifies.pop(0).payload)
+
+def _connect():
+    conn = db.connect_dedicated()
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {USER_CACHE_CHANNEL};")
+    return conn
+
+def _close():
+    global _conn, _fd, _listening
+    if _conn is None:
+        return
+    asyncio.get_running_loop().remove_reader(_fd)
+    try:
+        _conn.close()
+    except psycopg2.Error:
+        pass
+    _conn = None
+    _fd = None
+    _listening = False
+    clear()
+
+def _disconnect(error):
+    if _conn is not None:
+        logging.warning(f"User cache listener lost ({str(error).strip()}), clearing the cache.")
+        _close()
+
+def _ping():
+    with _conn.cursor() as cur:
+        cur.execute("SELECT 1;")
+
+# Keep the listening connection up: notifications missed while it was down are covered by
+# clearing the cache, which is bypassed until the listener is back
+async def _run():
+    global _conn, _fd, _listening
+    loop = asyncio.get_running_loop()
+    while True:
+        if _conn is None:
+            try:
+                _conn = await loop.run_in_executor(None, _connect)
+            except psycopg2.Error as e:
+                logging.warning(f"Could not start the user cache listener: {str(e).strip()}")
+                await asyncio.sleep(USER_CACHE_RECONNECT_DELAY)
+                continue
+            _fd = _conn.fileno()
+            loop.add_reader(_fd, _on_readable)
+            clear()
+            _listening = True
+            _stats['connects'] += 1
+        await asyncio.sleep(USER_CACHE_PING_INTERVAL)
+        if _conn is not None:
+            try:
+                await loop.run_in_executor(None, _ping)
+            except psycopg2.Error as e:
+                _disconnect(e)
+
+async def start():
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_run())
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    _close()
+
+def get_stats():
+    return dict(_stats, size=len(_cache), listening=int(_listening))
+
+metrics.register_collector(lambda: {(f'user_cache_{name}', None): value for name, value in get_stats().items()})
@@ -0,0 +1,98 @@
+import os
+import hmac
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+import httpd
+import payments
+import cryptobot
+
+# The webhook receiver is only started when a port is configured
+CRYPTBOT_WEBHOOK_HOST = os.getenv('CRYPTBOT_WEBHOOK_HOST', '0.0.0.0')
+CRYPTBOT_WEBHOOK_PORT = int(os.getenv('CRYPTBOT_WEBHOOK_PORT', '0'))
+CRYPTBOT_WEBHOOK_PATH = os.getenv('CRYPTBOT_WEBHOOK_PATH', '/cryptobot/webhook')
+
+# With webhooks enabled, polling is only a slow fallback sweep
+FALLBACK_POLL_INTERVAL = int(os.getenv('PAYMENT_FALLBACK_POLL_INTERVAL', '300'))
+
+# How many recently seen invoice IDs to remember for de-duplication
+DEDUP_CACHE_SIZE = 10000
+
+_server = None
+_seen_invoices = OrderedDict()
+_tasks = set()
+
+def is_enabled():
+    return CRYPTBOT_WEBHOOK_PORT > 0
+
+# CryptoBot signs the raw body with HMAC-SHA256, keyed by the SHA256 of the API token
+def verify_signature(body, signature):
+    if not signature or not cryptobot.CRYPTBOT_API_TOKEN:
+        return False
+    secret = hashlib.sha256(cryptobot.CRYPTBOT_API_TOKEN.encode()).digest()
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+# Returns True the first time an invoice ID is seen
+def _remember(invoice_id):
+    if invoice_id in _seen_invoices:
+        return False
+    _seen_invoices[invoice_id] = True
+    if len(_seen_invoices) > DEDUP_CACHE_SIZE:
+        _seen_invoices.popitem(last=False)
+    return True
+
+async def _confirm_payment(bot, invoice_id):
+    try:
+        rows = await payments.confirm_paid_invoice(invoice_id)
+    except Exception as e:
+        logging.error(f"Database error while confirming invoice {invoice_id} from webhook: {e}")
+        # Let a redelivery or the fallback sweep retry it
+        _seen_invoices.pop(invoice_id, None)
+        return
+    await payments.notify_paid(bot, rows)
+
+async def _handle_request(bot, method, path, headers, body):
+    if path != CRYPTBOT_WEBHOOK_PATH:
+        return 404, 'text/plain', b'not found'
+    if method != 'POST':
+        return 405, 'text/plain', b'method not allowed'
+    if not verify_signature(body, headers.get('crypto-pay-api-signature')):
+        logging.warning("Rejected CryptoBot webhook with an invalid signature.")
+        return 401, 'text/plain', b'invalid signature'
+
+    try:
+        update = json.loads(body)
+    except ValueError:
+        return 400, 'text/plain', b'invalid json'
+    # Anything but an object is malformed; a 500 would only make CryptoBot send it again
+    if not isinstance(update, dict) or not isinstance(update.get('payload', {}), dict):
+        return 400, 'text/plain', b'invalid update'
+
+    if update.get('update_type') == 'invoice_paid':
+        invoice_id = update.get('payload', {}).get('invoice_id')
+        if invoice_id is not None and _remember(invoice_id):
+            logging.info(f"Received invoice_paid webhook for invoice {invoice_id}")
+            # Acknowledge right away; the confirmation runs in the background
+            task = asyncio.create_task(_confirm_payment(bot, invoice_id))
+            _tasks.add(task)
+            task.add_done_callback(_tasks.discard)
+
+    return 200, 'application/json', b'{"ok":true}'
+
+async def start(bot):
+    global _server
+    _server = await httpd.serve(
+        CRYPTBOT_WEBHOOK_HOST,
+        CRYPTBOT_WEBHOOK_PORT,
+        lambda method, path, headers, body: _handle_request(bot, method, path, headers, body),
+    )
+
+async def stop():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None